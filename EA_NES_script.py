@@ -14,15 +14,18 @@ import argparse
 import warnings
 import time
 
-from game import Game
-from players import AI
-
-import concurrent.futures
+from simulator import simulate
+from players import BEAM_WIDTH
+from broker import Broker
+from checkpoint import save_run, restore_run, rng_state, set_rng_state
+from profiling import log_profile
+from telemetry import write_record, telemetry_path
+from evaluation import EvaluationPool, game_task, successive_halving, adaptive_fitness
 
 
 class NES:
 
-  def __init__(self, weights, steps, sigma, learningrate, population, piecelimit, run, log):
+  def __init__(self, weights, steps, sigma, learningrate, population, piecelimit, run, log, pool, commonseeds=True, rungs=None, keep=0.5, maxgames=1, checkpoint=True, timelimit=None, quorum=None, depth=1, beamwidth=BEAM_WIDTH):
     self.weights = weights
     self.steps = steps
     self.sigma = sigma
@@ -31,29 +34,95 @@ class NES:
     self.piecelimit = piecelimit
     self.run = run
     self.log = log
-
-  def runTetris(self, weights = None):
-    player = AI(weights)
-    game = Game(player)
-    game.new_game(pieceLimit = self.piecelimit)
-    reward = game.run_game()
+    self.pool = pool # worker processes, shared by all runs of an experiment
+    self.commonseeds = commonseeds # all samples of an iteration play the same piece sequence, a new one every iteration (there is no cache, every sample is new)
+    self.rungs = rungs # piece limits of successive halving of the samples, None for single games of piecelimit pieces
+    self.keep = keep # fraction of the samples promoted to the next rung
+    self.maxgames = maxgames # most games averaged per sample, above 1 a sample plays until its mean is precise enough
+    self.checkpoint = checkpoint # save the state after every iteration, and continue from a saved state
+    self.timelimit = timelimit # optional wall-clock budget per game in seconds, a game that hits it scores what it had so far
+    self.quorum = quorum # optional fraction of the samples; once that many games are finished the stragglers are stopped
+    self.depth = depth # search depth of the AI, 2 also searches the placements of the next piece
+    self.beamwidth = beamwidth # placements of the current piece that are searched further with depth 2
+    self.iteration = 0 # iterations done
+    self.fail_counter = 0
+    self.alreadyDone = False # True when the run was already finished before a restart
+    self.recordTime = time.time() # end of the last logged iteration, for the wall time of the next
+    if self.checkpoint:
+      self.restore()
+
+  def logPaths(self):
+    return 'NES_results/'+ str(self.run), 'NES_results/'+ str(self.run)+'failed', telemetry_path('NES_' + str(self.run))
+
+  # everything needed to continue the run exactly as if it had never stopped
+  def saveCheckpoint(self):
+    if not self.checkpoint:
+      return
+    save_run('NES_' + str(self.run), {
+      'weights': self.weights, 'iteration': self.iteration, 'fail_counter': self.fail_counter, 'rng': rng_state()},
+      self.checkpointConfig(), self.logPaths(), self.iteration >= self.steps)
+
+  # what the results of the run depend on, a checkpoint is only continued with the same
+  def checkpointConfig(self):
+    return {'steps': self.steps, 'sigma': self.sigma, 'learningrate': self.learningrate, 'population': self.population,
+            'piecelimit': self.piecelimit, 'commonseeds': self.commonseeds, 'rungs': self.rungs, 'keep': self.keep,
+            'maxgames': self.maxgames, 'timelimit': self.timelimit, 'quorum': self.quorum, 'depth': self.depth,
+            'beamwidth': self.beamwidth}
+
+  # continue from the checkpoint of this run (see restore_run), returns False when there is none
+  # (and sets alreadyDone without a checkpoint when the log of the run is already complete)
+  def restore(self):
+    state = restore_run('NES_' + str(self.run), self.checkpointConfig(), self.logPaths(), self.steps if self.log else None)
+    if state is None:
+      return False
+    self.alreadyDone = state['done']
+    if state.get('logComplete'):
+      print("Skipping", self.run, "(its log is complete)")
+      return True
+    self.weights = state['weights']
+    self.iteration = state['iteration']
+    self.fail_counter = state['fail_counter']
+    set_rng_state(state['rng'])
+    print("Resuming", self.run, "at iteration", self.iteration, "(done)" if self.alreadyDone else "")
+    return True
+
+  def runTetris(self, weights = None, seed = None):
+    reward, lines, pieces, budgetHit = simulate(weights, self.piecelimit, seed, self.depth, self.beamwidth, self.timelimit)
     return reward
 
-  def log_results(self, reward, iteration, failed, failed_weights):
+  # structured record of an iteration (see telemetry), the text log lines are written from it
+  def logTelemetry(self, reward, iteration, failed, failed_weights, seed):
+    now = time.time()
+    record = {
+      'iteration': iteration,
+      'time': now,
+      'wallSeconds': now - self.recordTime,
+      'reward': reward,
+      'weights': [float(w) for w in self.weights],
+      'failed': failed,
+      'failedWeights': [float(w) for w in failed_weights] if failed else None,
+      'seed': seed,
+      'evaluation': self.pool.take_telemetry(),
+    }
+    self.recordTime = now
+    write_record('NES_' + str(self.run), record)
+    return record
+
+  def log_results(self, reward, iteration, failed, failed_weights, seed=None):
+    record = self.logTelemetry(reward, iteration, failed, failed_weights, seed)
 
     with open('NES_results/'+ str(self.run), 'a') as file:
-      toLog = (str(iteration) + '|' + ", ".join(["{:.4f}".format(w) for w in self.weights]) + '|' + str(reward))
+      toLog = (str(record['iteration']) + '|' + ", ".join(["{:.4f}".format(w) for w in record['weights']]) + '|' + str(record['reward']))
       file.write(toLog + '\n')
 
-    if failed:
+    if record['failed']:
       with open('NES_results/'+ str(self.run)+'failed', 'a') as file:
-        toLog = (str(iteration) + '|' + ", ".join(["{:.4f}".format(w) for w in failed_weights]) + '|' + str(reward))
+        toLog = (str(record['iteration']) + '|' + ", ".join(["{:.4f}".format(w) for w in record['failedWeights']]) + '|' + str(record['reward']))
         file.write(toLog + '\n')
 
 
   def optimize(self):
-    fail_counter = 0
-    i = 0
+    i = self.iteration
     failed = False
 
     while i < self.steps:
@@ -62,20 +131,31 @@ class NES:
 
     
       N = np.random.randn(self.population, len(self.weights))
+      # common random numbers: the rewards of the samples only differ because of their weights
+      seed = int(np.random.randint(2**31)) if self.commonseeds else None
       R = np.zeros(self.population)
       X = []
       solutions = []
-      processList = []
      
       for j in range(self.population):
           solutions.append(self.weights + self.sigma*N[j])
 
-      with concurrent.futures.ProcessPoolExecutor() as executor:
-        for j in range(self.population):
-          processList.append(executor.submit(self.runTetris, tuple(solutions[j])))
-        
-        for t in processList:         
-          X.append(t.result())
+      if self.rungs:
+        # successive halving: the obviously bad samples only play short games
+        X = [score for score, final in successive_halving(self.pool, solutions, self.rungs, self.keep, seed,
+                                                          self.timelimit, self.quorum, self.depth, self.beamwidth)]
+      elif self.maxgames > 1:
+        # every sample counts in the gradient, so there is no cutoff: play until the mean is precise enough
+        X = [mean for mean, stderr, games, final in adaptive_fitness(self.pool, solutions, None, maxGames=self.maxgames,
+                                                                      seed=seed, pieceLimit=self.piecelimit,
+                                                                      timeLimit=self.timelimit, quorum=self.quorum,
+                                                                      depth=self.depth, beamWidth=self.beamwidth)]
+      else:
+        # only the weights, piece limit and seed go to the workers, not this NES instance
+        tasks = [game_task(solutions[j], self.piecelimit, seed, self.timelimit, None, self.depth, self.beamwidth)
+                 for j in range(self.population)]
+        for reward, lines, pieces, budgetHit in self.pool.play(tasks, quorum=self.quorum):
+          X.append(reward)
       
       #Try and catch for calculating the gradient in case of rewards being 0.
       try:
@@ -84,13 +164,11 @@ class NES:
         self.weights += self.learningrate * grad
 
       except FloatingPointError:
+        # start again from new random weights, but keep the iterations (and the log) done so far;
+        # the failed weights go to the failed log
         self.weights = np.random.uniform(low = -1.5, high = 1.5, size= (8,))
-        fail_counter += 1 
-        i = 0
+        self.fail_counter += 1
         failed = True
-        with open('NES_results/'+ str(self.run), 'w') as file:
-          file.truncate()
-          file.close()
 
 
 
@@ -105,28 +183,39 @@ class NES:
           (i, str(self.weights), reward))
 
       if self.log == True and failed == False:
-        self.log_results(reward, i, False, 0)
+        self.log_results(reward, i, False, 0, seed)
       elif self.log == True and failed == True:
-        self.log_results(reward, i,True, failed_weights)
+        self.log_results(reward, i,True, failed_weights, seed)
       failed = False
+      # hot path profile of the games of this iteration, only when the pool profiles
+      log_profile('NES_' + str(self.run), 'iteration ' + str(i), self.pool.take_profile())
       i += 1
+      self.iteration = i
+      self.saveCheckpoint()
 
 
 
 
 
-def run_experiment(steps, sigma, learningrate, population, piecelimit,  runs, log,  experiment_name):
+def run_experiment(steps, sigma, learningrate, population, piecelimit,  runs, log,  experiment_name, workers=None, affinity=None, commonseeds=True, rungs=None, keep=0.5, maxgames=1, broker=None, checkpoint=True, timelimit=None, quorum=None, profile=False, depth=1, beamwidth=BEAM_WIDTH, lockstep=False):
+  # created once, used by all runs; with a broker address the games go to remote workers (python broker.py HOST PORT), both need $TETRIS_BROKER_AUTHKEY
+  # with profile the workers count the calls and time of the AI hot path, a report per iteration goes to profiles/
+  # with lockstep every worker plays its share of the samples together, see population_simulator
+  pool = Broker(broker, workers=workers) if broker else EvaluationPool(workers, affinity, profile, lockstep)
   for run in range(runs):
     start = time.time()
     experiment = str(run) + '_' + experiment_name
     weights = np.random.uniform(low = -1.5, high = 1.5, size= (8,))
-    samplerun = NES(weights, steps, sigma, learningrate, population, piecelimit, experiment, log)
+    samplerun = NES(weights, steps, sigma, learningrate, population, piecelimit, experiment, log, pool, commonseeds, rungs, keep, maxgames, checkpoint, timelimit, quorum, depth, beamwidth)
+    if samplerun.alreadyDone: # finished before a restart, its results are already logged
+      continue
     samplerun.optimize()
     end = time.time()
     runtime = end - start
     with open('NES_results/'+ 'runtime', 'a') as file:
           toLog = str(run) + '_' + (str(experiment) + '|' + str(runtime))
           file.write(toLog + '\n')
+  pool.close()
 
 weights = [0.3, -0.4, -0.5, -0.3, -0.4, -0.5, -0.1, 0.4] #working weights
 """
@@ -139,6 +228,8 @@ sigma = 0.1 #size of gaussian sampling
 learningrate = 0.01 #learningrate 
 population = 100 #number of weights samples from the gaussian distribution
 piecelimit = -1 #piecelimit for the game (-1 is unlimited)
+depth = 1 #search depth of the AI, 2 also looks at the next piece (much slower games)
+beamwidth = 4 #placements of the current piece searched further with depth 2
 runs = 10#Number of runs
 log = True #When set to True it will create a log file per run with results
 experiment_name = 'baseline_32_01_001_100_-1_10' #this name will be the name of your file + corresponding run number
@@ -150,7 +241,7 @@ Baseline experimenst
 ------------------------
 """
 
-run_experiment(steps,sigma, learningrate, population,piecelimit,runs, log, experiment_name)
+run_experiment(steps,sigma, learningrate, population,piecelimit,runs, log, experiment_name, depth=depth, beamwidth=beamwidth)
 #run_experiment(32, 0.1, 0.01, 50, -1, 10, True, 'baseline_red_pop_32_01_001_50_-1_10')
 #run_experiment(32, 0.1, 0.01, 25, -1, 10, True, 'baseline_red_pop2_32_01_001_25_-1_10')
 #run_experiment(64, 0.1, 0.01, 100, -1, 10, True, 'baseline_increasedsteps_64_01_001_100_-1_10')
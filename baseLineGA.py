@@ -6,14 +6,18 @@ import sys
 import numpy as np
 import math
 import random
-import concurrent.futures
 import matplotlib.pyplot as plt
-from game import Game
 import time
 
-from players import AI
+from broker import Broker
+from checkpoint import save_run, restore_run, rng_state, set_rng_state
+from profiling import log_profile
+from telemetry import write_record, telemetry_path
+from evaluation import EvaluationPool, game_task, adaptive_fitness
 
 PIECELIMIT = -1 #500 # Maximum number of pieces in a game before game over. Set to -1 for unlimited
+DEPTH = 1 # Search depth of the AI, 2 also searches the placements of the next (preview) piece; much slower games
+BEAM_WIDTH = 4 # Placements of the current piece that are searched further with DEPTH 2
 
 ########################
 # HYPER PARAMETERS
@@ -22,6 +26,18 @@ P_MUTATION = 0.1 # mutation probability
 P_CROSSOVER = 0.5 # crossover probability
 P_POPULATIONSIZE = 100
 P_GENERATIONS = 32 
+SEED_INTERVAL = None # Generations between new piece sequences that all candidates play (0 for one per run, None for a random sequence per game);
+                     # the baseline keeps its original random games, it has no fitness cache to keep useful
+MAX_GAMES = 1 # Most games averaged per candidate. Above 1 a candidate plays until its ranking is clear (at least MIN_GAMES games)
+MIN_GAMES = 3
+CHECKPOINT = True # Save the state of a run after every generation, a restarted run continues from it and finished runs are skipped
+TIME_LIMIT = None # Optional wall-clock budget per game in seconds, a game that hits it scores what it had so far
+QUORUM = None # Optional fraction of a generation; once that many games are finished the running games are stopped with their partial score, the others get the median game time
+WORKERS = None # Number of worker processes playing games, None for one per CPU
+AFFINITY = None # Optional list of CPU ids to pin the workers to
+LOCKSTEP = False # Every worker plays its share of a generation in lock-step (see population_simulator), greedy games without replays only; with QUORUM in four smaller chunks, so the quorum does not wait for whole workers
+PROFILE = False # Count the calls and time of the AI hot path in the workers, a report per generation goes to profiles/ (remote workers: python broker.py HOST PORT --profile)
+BROKER = None # (host, port) to serve the games to remote workers (python broker.py HOST PORT) instead of local processes, needs $TETRIS_BROKER_AUTHKEY
 LOG = True #When set to True it will create a log file per run with results
 EXP_NAME = 'test Basic'
 
@@ -45,7 +61,7 @@ Steps (you can see them back in the code below):
 class SimpleEA:
 
     # constructor
-    def __init__(self, weights, popsize = 50, poffspring = 0.7, pmut = 0.1, termgeneration = 10, log = False, experiment_name = " ", run = 0):
+    def __init__(self, weights, popsize = 50, poffspring = 0.7, pmut = 0.1, termgeneration = 10, log = False, experiment_name = " ", run = 0, pool = None, checkpoint = CHECKPOINT):
         self.weights = weights # list of weights, represented by a list containing weight values
         self.popsize = popsize # population size
         self.poffspring = poffspring # offspring probability
@@ -54,8 +70,17 @@ class SimpleEA:
         self.log = log #When set to True it will create a log file per run with results
         self.experiment_name = experiment_name #name for logging purposes
         self.run = run # run number for logging purposes
+        self.pool = pool or EvaluationPool(WORKERS, AFFINITY, PROFILE, LOCKSTEP) # worker processes, shared by all runs of an experiment
+        self.ownPool = pool is None # a pool created here is closed by close, one passed in belongs to the caller
+        self.seed = None # seed of the piece sequence of the current generation
+        self.checkpoint = checkpoint # save the state after every generation, and continue from a saved state
         self.bestScoreList = []
         self.bestWeightsList = []
+        self.generation = 0 # generations done
+        self.alreadyDone = False # True when the run was already finished before a restart
+        self.recordTime = time.time() # end of the last logged generation, for the wall time of the next
+        if self.checkpoint and self.restore():
+            return
 
         # initialize population using weights and popsize
         # population is represented by list of weights
@@ -69,41 +94,96 @@ class SimpleEA:
             self.population.append(self.normalize(tempweights))
         
         print("Running generation: 0");
+        self.updateSeed(0)
         #Step 2) evaluate quality candidate
-        self.fitnesses = []
-        processList = []
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            for i in range(self.popsize):
-                processList.append(executor.submit(self.calculateFitness, self.population[i]))
-                
-            for t in processList:
-                self.fitnesses.append(t.result())
+        self.fitnesses = self.evaluateAll(self.population)
 
         # add best result of initial population and the corresponding set of weights
         self.bestScoreList.append(max(self.fitnesses))
         self.bestWeightsList.append(self.population[self.fitnesses.index(max(self.fitnesses))])
 
         self.printGeneration(0)
-
-    # Get score from weights
-    def runTetris(self, weights = None):
-        player = AI(weights)
-        game = Game(player)
-        game.new_game(pieceLimit = PIECELIMIT)
-        return game.run_game()
-
-    # calculate fitness of a specific instance of the population
-    def calculateFitness(self, weights):
-        #TODO 2, algorithm is going to play tetris and returns its score
-        #fitness = sum(weights) #temp
-        fitness = self.runTetris(tuple(weights))
-        #print("weights", weights, "gave a score of:", fitness)
-        return fitness
+        self.logProfile(0)
+        if self.log == True:
+            self.logTelemetry(0) # no text line, the text log starts at generation 1
+        self.saveCheckpoint()
+
+    # closes what this instance created itself, see ownPool
+    def close(self):
+        if self.ownPool:
+            self.pool.close()
+
+    def checkpointName(self):
+        return 'BEA_' + str(self.experiment_name)
+
+    # text log first, then the telemetry
+    def logPaths(self):
+        return 'BEA_results/' + str(self.experiment_name), telemetry_path(self.checkpointName())
+
+    # everything needed to continue the run exactly as if it had never stopped
+    def saveCheckpoint(self):
+        if not self.checkpoint:
+            return
+        save_run(self.checkpointName(), {
+            'population': self.population, 'fitnesses': self.fitnesses,
+            'bestScoreList': self.bestScoreList, 'bestWeightsList': self.bestWeightsList,
+            'generation': self.generation, 'seed': self.seed, 'rng': rng_state()},
+            self.checkpointConfig(), self.logPaths(), self.generation >= self.termgeneration)
+
+    # what the results of the run depend on, a checkpoint is only continued with the same
+    def checkpointConfig(self):
+        return {
+            'popsize': self.popsize, 'poffspring': self.poffspring, 'pmut': self.pmut, 'termgeneration': self.termgeneration,
+            'pieceLimit': PIECELIMIT, 'seedInterval': SEED_INTERVAL, 'maxGames': MAX_GAMES, 'minGames': MIN_GAMES,
+            'timeLimit': TIME_LIMIT, 'quorum': QUORUM, 'depth': DEPTH, 'beamWidth': BEAM_WIDTH}
+
+    # continue from the checkpoint of this run (see restore_run), returns False when there is none
+    # (True without a checkpoint when the log of the run is already complete)
+    def restore(self):
+        state = restore_run(self.checkpointName(), self.checkpointConfig(), self.logPaths(),
+                            self.termgeneration if self.log else None)
+        if state is None:
+            return False
+        self.alreadyDone = state['done']
+        if state.get('logComplete'):
+            print("Skipping", self.experiment_name, "(its log is complete)")
+            return True
+        self.population = state['population']
+        self.fitnesses = state['fitnesses']
+        self.bestScoreList = state['bestScoreList']
+        self.bestWeightsList = state['bestWeightsList']
+        self.generation = state['generation']
+        self.seed = state['seed']
+        set_rng_state(state['rng'])
+        print("Resuming", self.experiment_name, "after generation", self.generation, "(done)" if self.alreadyDone else "")
+        return True
+
+    # all candidates of a generation play the same pieces (common random numbers), so their
+    # scores differ because of the weights and not because of the luck of the draw
+    def updateSeed(self, generation):
+        if SEED_INTERVAL is None:
+            self.seed = None
+        elif generation == 0 or (SEED_INTERVAL > 0 and generation % SEED_INTERVAL == 0):
+            self.seed = random.randrange(2**32)
+
+    # fitness of every instance
+    def evaluateAll(self, instances):
+        if MAX_GAMES > 1:
+            # more games only for candidates that might be on either side of the median,
+            # which decides most binary tournaments
+            cutoff = lambda means: float(np.median(means))
+            estimates = adaptive_fitness(self.pool, instances, cutoff, MIN_GAMES, MAX_GAMES,
+                                         seed=self.seed, pieceLimit=PIECELIMIT, timeLimit=TIME_LIMIT, quorum=QUORUM,
+                                         depth=DEPTH, beamWidth=BEAM_WIDTH)
+            return [mean for mean, stderr, games, final in estimates]
+        # only the weights, piece limit and seed go to the workers, not this SimpleEA instance
+        results = self.pool.play([game_task(w, PIECELIMIT, self.seed, TIME_LIMIT, None, DEPTH, BEAM_WIDTH) for w in instances],
+                                 quorum = QUORUM)
+        return [score for score, lines, pieces, budgetHit in results]
 
     # evaluates quality of each candidate by updating the fitnesses list
     def evaluatePopulation(self):
-        for i in range(self.popsize):
-            self.fitnesses[i] = self.calculateFitness(i)
+        self.fitnesses = self.evaluateAll(self.population)
 
     # binary tournament selection
     # returns a single candidate (index)
@@ -167,6 +247,10 @@ class SimpleEA:
             averageweights[i] = averageweights[i]/len(self.population)
         return averageweights
 
+    # hot path profile of the games played since the last report, only when the pool profiles
+    def logProfile(self, generation):
+        log_profile('BEA_' + str(self.experiment_name), 'generation ' + str(generation), self.pool.take_profile())
+
     def printGeneration(self, generation):
         # Print generation results
         print("Best score for generation", generation, ":", max(self.fitnesses))
@@ -175,19 +259,39 @@ class SimpleEA:
         print("Average weights for generation", generation, ":",  [ '%.3f' % w for w in self.averageWeights() ])
         print("-------------------------")
         
+    # structured record of a generation (see telemetry), the text log line is written from it
+    def logTelemetry(self, generation):
+        best = self.fitnesses.index(max(self.fitnesses))
+        now = time.time()
+        record = {
+            'generation': generation,
+            'time': now,
+            'wallSeconds': now - self.recordTime,
+            'best': self.fitnesses[best],
+            'bestWeights': [float(w) for w in self.population[best]],
+            'average': sum(self.fitnesses)/len(self.fitnesses),
+            'averageWeights': [float(w) for w in self.averageWeights()],
+            'seed': self.seed,
+            'evaluation': self.pool.take_telemetry(),
+        }
+        self.recordTime = now
+        write_record(self.checkpointName(), record)
+        return record
+
     def log_results(self, generation):
+        record = self.logTelemetry(generation)
         with open('BEA_results/'+ str(self.experiment_name), 'a') as file:
-            toLog = (str(generation) + '|' 
-                + ", ".join(['%.4f' % x for x in self.population[self.fitnesses.index(max(self.fitnesses))]]) 
-                + '|' + str(max(self.fitnesses))
-                + '|' + ", ".join(['%.4f' % x for x in self.averageWeights()]) 
-                + '|' + str((sum(self.fitnesses)/len(self.fitnesses))))
+            toLog = (str(record['generation']) + '|' 
+                + ", ".join(['%.4f' % x for x in record['bestWeights']]) 
+                + '|' + str(record['best'])
+                + '|' + ", ".join(['%.4f' % x for x in record['averageWeights']]) 
+                + '|' + str(record['average']))
             file.write(toLog + '\n')
 
     # TODO
     # STEP 3: run algorithm until termination condition satisfied
     def runEA(self):
-        generation = 0
+        generation = self.generation
         while generation < self.termgeneration:
 
             nextGeneration = [] # list containing the next generation
@@ -225,15 +329,10 @@ class SimpleEA:
 
             generation += 1
             print("Running generation:", generation);
+            self.updateSeed(generation)
 
             # d: Evaluate the new candidates
-            nextGenerationFitnesses = []
-            processList = []
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                for c in range(self.popsize):
-                    processList.append(executor.submit(self.calculateFitness, nextGeneration[c]))
-                for t in processList:
-                    nextGenerationFitnesses.append(t.result())
+            nextGenerationFitnesses = self.evaluateAll(nextGeneration)
 
             # average fitness decrease. Not used, but can be interesting
             """
@@ -251,9 +350,12 @@ class SimpleEA:
             self.bestWeightsList.append(self.population[self.fitnesses.index(max(self.fitnesses))])
 
             self.printGeneration(generation)
+            self.logProfile(generation)
 
             if self.log == True:
                 self.log_results(generation)
+            self.generation = generation
+            self.saveCheckpoint()
             # done with iteration
 
         # when done, return the list of best scores for each iteration
@@ -261,19 +363,27 @@ class SimpleEA:
 
     
 runs = 10 #Number of runs
-for run in range(runs):
-    start = time.time()
-    experiment = str(run) + '_' + "Base"
-    bleh = SimpleEA([None]*8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run)
-    bleh.runEA()
-    end = time.time()
-    with open('BEA_results/'+ "Base" + "_times", 'a') as file:
-        file.write("Running time: " + str(end-start) + " seconds" + '\n')
+pool = Broker(BROKER, workers=WORKERS) if BROKER else EvaluationPool(WORKERS, AFFINITY, PROFILE, LOCKSTEP) # created once, used by all runs
+try:
+    for run in range(runs):
+        start = time.time()
+        experiment = str(run) + '_' + "Base"
+        bleh = SimpleEA([None]*8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run, pool)
+        if bleh.alreadyDone: # finished before a restart, its results are already logged
+            continue
+        bleh.runEA()
+        end = time.time()
+        with open('BEA_results/'+ "Base" + "_times", 'a') as file:
+            file.write("Running time: " + str(end-start) + " seconds" + '\n')
+finally: # the worker processes (or the listener of the broker) are not left to the interpreter
+    pool.close()
 """
 for run in range(runs):
     start = time.time()
     experiment = str(run) + '_' + "10pop"
-    bleh = SimpleEA([None]*8, 10, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run)
+    bleh = SimpleEA([None]*8, 10, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run, pool)
+    if bleh.alreadyDone: # finished before a restart, its results are already logged
+        continue
     bleh.runEA()
     end = time.time()
     with open('BEA_results/'+ "10pop" + "_times", 'a') as file:
@@ -282,7 +392,9 @@ for run in range(runs):
 for run in range(runs):
     start = time.time()
     experiment = str(run) + '_' + "20pop"
-    bleh = SimpleEA([None]*8, 20, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run)
+    bleh = SimpleEA([None]*8, 20, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run, pool)
+    if bleh.alreadyDone: # finished before a restart, its results are already logged
+        continue
     bleh.runEA()
     end = time.time()
     with open('BEA_results/'+ "20pop" + "_times", 'a') as file:
@@ -291,7 +403,9 @@ for run in range(runs):
 for run in range(runs):
     start = time.time()
     experiment = str(run) + '_' + "50pop"
-    bleh = SimpleEA([None]*8, 50, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run)
+    bleh = SimpleEA([None]*8, 50, P_CROSSOVER, P_MUTATION, P_GENERATIONS, LOG, experiment, run, pool)
+    if bleh.alreadyDone: # finished before a restart, its results are already logged
+        continue
     bleh.runEA()
     end = time.time()
     with open('BEA_results/'+ "50pop" + "_times", 'a') as file:
@@ -301,7 +415,9 @@ for mr in range(5):
     for run in range(runs):
         start = time.time()
         experiment = str(run) + '_' + "MutationRate_" + str(mr+1)
-        bleh = SimpleEA([None]*8, P_POPULATIONSIZE, P_CROSSOVER, ((mr+1)/10), P_GENERATIONS, LOG, experiment, run)
+        bleh = SimpleEA([None]*8, P_POPULATIONSIZE, P_CROSSOVER, ((mr+1)/10), P_GENERATIONS, LOG, experiment, run, pool)
+        if bleh.alreadyDone: # finished before a restart, its results are already logged
+            continue
         bleh.runEA()
         end = time.time()
         with open('BEA_results/'+ "MutationRate_" + str(mr+1) + "_times", 'a') as file:
@@ -311,7 +427,9 @@ for co in range(3):
     for run in range(runs):
         start = time.time()
         experiment = str(run) + '_' + "CrossoverRate_" + str(co+1)
-        bleh = SimpleEA([None]*8, P_POPULATIONSIZE, (co+1)*0.25 , P_MUTATION, P_GENERATIONS, LOG, experiment, run)
+        bleh = SimpleEA([None]*8, P_POPULATIONSIZE, (co+1)*0.25 , P_MUTATION, P_GENERATIONS, LOG, experiment, run, pool)
+        if bleh.alreadyDone: # finished before a restart, its results are already logged
+            continue
         bleh.runEA()
         end = time.time()
         with open('BEA_results/'+ "CrossoverRate_" + str(co+1) + "_times", 'a') as file:
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""Benchmarks of the game engine and the AI on seeded workloads.
+
+The boards of every benchmark come from seeded headless games, so every run
+measures exactly the same work. Results are written as JSON; given a stored
+baseline, every benchmark that got slower than the threshold allows is
+reported and the script exits with status 1.
+
+    python benchmark.py -o bench.json                  # measure and save
+    python benchmark.py -b bench.json -t 0.10          # compare with a baseline
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from game_board import Board
+from players import (AI, getFullRows, getHoles, getHoleDepth, getBumpiness, getDeepWells,
+                     getShallowWells, getPatternDiversity, getDeltaHeight, getHeights)
+from simulator import simulate
+
+WEIGHTS = (0.5, -1.0, -0.2, -0.3, 0.1, -0.1, -0.3, 0.2) # plays long games, so the boards fill up
+SEEDS = (1, 2, 3)
+SNAPSHOT_EVERY = 10 # pieces between two boards of the workload
+THRESHOLD = 0.10 # default allowed slowdown before a benchmark counts as a regression
+MIN_TIME = 0.05 # seconds a single measurement takes at least, short benchmarks are run several times
+
+
+def snapshot_boards(seeds=SEEDS, pieceLimit=300):
+    """Copies of the board (with a falling shape) every SNAPSHOT_EVERY pieces of seeded games."""
+    player = AI(WEIGHTS)
+    boards = []
+    for seed in seeds:
+        board = Board(pieceLimit=pieceLimit, seed=seed)
+        board.next_tetromino()
+        pieces = 0
+        playing = board.spawn_shape()
+        while playing:
+            if pieces % SNAPSHOT_EVERY == 0:
+                snapshot = board.deepBoardCopy()
+                shape = board.falling_shape
+                snapshot.falling_shape = type(shape)(shape.column_position, shape.row_position,
+                                                     shape.color, shape.orientation)
+                boards.append(snapshot)
+            row, column, orientation = player.get_moves(board, None)
+            if row is None:
+                break
+            playing = board.place_falling_shape(column, row, orientation)
+            pieces += 1
+    return boards
+
+
+def placed_shapes(boards):
+    """(board, shape) pairs of every placement the AI considers on the boards, at their landing row."""
+    player = AI(WEIGHTS)
+    pairs = []
+    for board in boards:
+        for shape in player.candidate_placements(board):
+            pairs.append((board, type(shape)(shape.column_position, shape.row_position,
+                                             shape.color, shape.orientation)))
+    return pairs
+
+
+def boards_with_full_rows(pairs):
+    """Boards on which a placement completed rows, with the rows not cleared yet."""
+    boards = []
+    for board, shape in pairs:
+        copy = board.deepBoardCopy()
+        copy._settle_shape_no_clear(shape)
+        if copy.full_rows:
+            boards.append(copy)
+    return boards
+
+
+def timed(run, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        run()
+    return time.perf_counter() - start
+
+
+def measure(run, calls, repeat):
+    """Best of repeat measurements of run() (which makes calls calls), in microseconds per call.
+    Like timeit, run() is repeated within a measurement until it takes at least MIN_TIME."""
+    number = 1
+    while timed(run, number) < MIN_TIME:
+        number *= 2
+    best = min(timed(run, number) for _ in range(repeat))
+    return best / (calls * number) * 1e6
+
+
+def run_benchmarks(repeat=5, quick=False):
+    """Runs all benchmarks, returns a dict name -> {'us_per_call': ..., 'calls': ...}."""
+    seeds = SEEDS[:1] if quick else SEEDS
+    boards = snapshot_boards(seeds)
+    pairs = placed_shapes(boards)
+    fullBoards = boards_with_full_rows(pairs)
+    heights = [getHeights(board) for board in boards]
+    player = AI(WEIGHTS)
+    results = {}
+
+    def bench(name, run, calls):
+        results[name] = {'us_per_call': measure(run, calls, repeat), 'calls': calls}
+
+    def loop(function, items):
+        return lambda: [function(item) for item in items]
+
+    bench('Board.shape_cannot_be_placed', lambda: [board.shape_cannot_be_placed(shape) for board, shape in pairs],
+          len(pairs))
+    bench('Board.deepBoardCopy', loop(Board.deepBoardCopy, boards), len(boards))
+
+    # remove_completed_lines changes the board, so every measurement gets fresh copies (made outside the timing)
+    def clear_lines(number):
+        copies = [board.deepBoardCopy() for _ in range(number) for board in fullBoards]
+        start = time.perf_counter()
+        for board in copies:
+            board.remove_completed_lines()
+        return time.perf_counter() - start
+
+    number = 1
+    while fullBoards and clear_lines(number) < MIN_TIME:
+        number *= 2
+    best = min(clear_lines(number) for _ in range(repeat))
+    results['Board.remove_completed_lines'] = {'us_per_call': best / max(1, len(fullBoards) * number) * 1e6,
+                                               'calls': len(fullBoards)}
+
+    for feature in (getFullRows, getHoles, getHoleDepth, getHeights):
+        bench('players.' + feature.__name__, loop(feature, boards), len(boards))
+    for feature in (getBumpiness, getDeepWells, getShallowWells, getPatternDiversity, getDeltaHeight):
+        bench('players.' + feature.__name__, loop(feature, heights), len(heights))
+
+    bench('AI.score_board', lambda: [player.score_board(board, board) for board in boards], len(boards))
+    bench('AI.get_moves', lambda: [player.get_moves(board, None) for board in boards], len(boards))
+    # a new player for every move, its transposition table would otherwise remember the boards of earlier runs
+    bench('AI.get_moves (depth 2)', lambda: [AI(WEIGHTS, depth=2).get_moves(board, None) for board in boards],
+          len(boards))
+
+    # end to end: whole seeded games, per placed piece
+    pieces = sum(simulate(WEIGHTS, 300, seed)[2] for seed in seeds)
+    bench('simulate (per piece)', lambda: [simulate(WEIGHTS, 300, seed) for seed in seeds], pieces)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Names of the benchmarks that are more than threshold (a fraction) slower than the baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result['us_per_call'] / baseline[name]['us_per_call']
+        status = 'REGRESSION' if ratio > 1 + threshold else ''
+        print('%-32s %10.2f us  baseline %10.2f us  %+6.1f%%  %s' % (
+            name, result['us_per_call'], baseline[name]['us_per_call'], (ratio - 1) * 100, status))
+        if status:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                        help='allowed slowdown as a fraction (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per benchmark, the best counts')
+    parser.add_argument('--quick', action='store_true', help='one seed instead of %d' % len(SEEDS))
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat, args.quick)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(len(regressions), 'benchmark(s) slower than the baseline by more than %d%%' % (args.threshold * 100))
+            return 1
+    else:
+        for name, result in sorted(results.items()):
+            print('%-32s %10.2f us  (%d calls)' % (name, result['us_per_call'], result['calls']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
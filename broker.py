@@ -0,0 +1,370 @@
+"""Distributed fitness evaluation: a broker that hands games to remote workers.
+
+The broker listens on a socket; worker processes (on this or any other machine)
+connect to it, receive chunks of game tasks (see evaluation.game_task) and send
+back their (score, lines, pieces, budget hit). Once the quorum of a batch is
+reached, the broker cancels it on every worker, with the same effect as in an
+EvaluationPool (see evaluation.play_games). Workers send heartbeats while they
+play; a worker that disconnects or stays silent for longer than the timeout is
+dropped and its unfinished tasks are handed to another worker. A task that is finished
+twice (by a dropped worker that turns out to be alive and by its replacement)
+only counts once.
+
+A Broker can be used everywhere an evaluation.EvaluationPool is used. To start
+workers on another machine:
+
+    python broker.py HOST PORT [PROCESSES] [--profile] [--authkey KEY]
+
+With --profile the workers also send the profiling stats of their games, see
+profiling and Broker.take_profile.
+
+The connections unpickle every message they receive, so whoever knows the shared
+secret (the authkey) can run code on the broker and on its workers. There is no
+default secret: pass it to Broker and run_worker, or set it in the environment
+variable AUTHKEY_VARIABLE on every machine. The broker only listens on localhost
+unless another address is given.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+import profiling
+from evaluation import init_worker, play_chunk, quorum_budget
+from telemetry import Telemetry, pickled
+
+PORT = 6015 # default port of the broker
+AUTHKEY_VARIABLE = 'TETRIS_BROKER_AUTHKEY' # environment variable with the shared secret of the broker and its workers
+HEARTBEAT = 2.0 # seconds between the heartbeats of a worker
+TIMEOUT = 10.0 # seconds of silence after which a worker is considered lost
+RETRIES = 3 # how often a task is handed out again after its worker was lost
+
+
+def get_authkey(authkey=None):
+    """The shared secret as bytes: authkey, or else the one in the environment variable
+    AUTHKEY_VARIABLE. Raises a ValueError when there is neither, there is no default."""
+    authkey = authkey or os.environ.get(AUTHKEY_VARIABLE)
+    if not authkey:
+        raise ValueError('the broker and its workers need a shared secret, pass an authkey or set %s'
+                         % AUTHKEY_VARIABLE)
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def run_worker(address, authkey=None, heartbeat=HEARTBEAT, profile=False):
+    """Connects to the broker at address and plays the games it sends until it is stopped.
+    authkey is the shared secret (see get_authkey). With profile the profiling stats of
+    every chunk are sent along with its results."""
+    authkey = get_authkey(authkey)
+    cancelled = multiprocessing.Value('l', -1, lock=False) # as in an EvaluationPool, see evaluation.play_games
+    budget = multiprocessing.Value('d', 0.0, lock=False)
+    init_worker(cancelled=cancelled, budget=budget, profile=profile)
+    connection = Client(address, authkey=authkey)
+    lock = threading.Lock() # the heartbeat thread and the games share the connection
+    stopped = threading.Event()
+    messages = queue.Queue() # chunks to play, read while the games are playing to get cancellations in time
+
+    def receive():
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == 'cancel':
+                    budget.value = message[2]
+                    cancelled.value = max(cancelled.value, message[1])
+                    continue
+                messages.put(message)
+                if message[0] == 'stop':
+                    return
+        except (OSError, EOFError): # the broker is gone
+            messages.put(('stop',))
+
+    def beat():
+        while not stopped.wait(heartbeat):
+            try:
+                with lock:
+                    connection.send(('heartbeat',))
+            except (OSError, EOFError):
+                return
+
+    threading.Thread(target=beat, daemon=True).start()
+    threading.Thread(target=receive, daemon=True).start()
+    try:
+        while True:
+            message = messages.get()
+            if message[0] == 'stop':
+                break
+            results, stats, timing = play_chunk(message[2], message[3])
+            with lock:
+                connection.send(('results', message[1], results, stats, timing))
+    except (OSError, EOFError): # the broker is gone
+        pass
+    finally:
+        stopped.set()
+        connection.close()
+
+
+class WorkerLost(Exception):
+    pass
+
+
+class Broker(object):
+    """Serves games to remote worker processes, in place of an EvaluationPool.
+
+    address is the (host, port) to listen on, only this machine by default; port 0 picks
+    a free port, see self.address. authkey is the shared secret of the broker and its
+    workers, by default the one in the environment (see get_authkey).
+    Every worker gets chunks of at most chunksize tasks of the same batch. A task
+    whose worker is lost is retried up to retries times before its Future fails.
+    workers is the number of workers the optimizers plan for (how many games the
+    steady-state GA keeps in flight), by default the number of connected workers.
+    profile turns profiling on in the workers started by start_local_workers.
+    """
+
+    def __init__(self, address=('localhost', PORT), authkey=None, chunksize=4, timeout=TIMEOUT,
+                 retries=RETRIES, workers=None, profile=False):
+        authkey = get_authkey(authkey)
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.chunksize = chunksize
+        self.timeout = timeout
+        self.retries = retries
+        self.expectedWorkers = workers
+        self.profiling = profile
+        self.profile = {} # stats sent back by the workers since the last take_profile
+        self.telemetry = Telemetry()
+        self.tasks = queue.Queue() # task ids waiting for a worker
+        self.pending = {} # task id -> (task, Future, batch); the batch is None for single games
+        self.dispatched = set() # ids of the pending tasks a worker is playing
+        self.attempts = collections.Counter() # task id -> number of lost workers it was sent to
+        self.durations = {} # task id -> seconds its game took, for the tasks of a batch that is playing
+        self.nextId = 0
+        self.batches = 0
+        self.cancel = None # the last ('cancel', batch, budget) message, also sent to workers that connect later
+        self.connections = []
+        self.localWorkers = []
+        self.lock = threading.Lock()
+        self.sendLock = threading.Lock() # the threads serving the workers and play both send
+        self.closed = False
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def workers(self):
+        if self.expectedWorkers:
+            return self.expectedWorkers
+        return max(1, len(self.connections))
+
+    def start_local_workers(self, processes):
+        """Starts worker processes on this machine, a "cluster" for testing or for a single node."""
+        host = self.address[0] if self.address[0] not in ('', '0.0.0.0') else 'localhost'
+        for _ in range(processes):
+            process = multiprocessing.Process(target=run_worker, args=((host, self.address[1]), self.authkey, HEARTBEAT, self.profiling),
+                                              daemon=True)
+            process.start()
+            self.localWorkers.append(process)
+        return self.localWorkers[-processes:]
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            with self.lock:
+                self.connections.append(connection)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _send(self, connection, message):
+        with self.sendLock:
+            connection.send(message)
+
+    def _next_chunk(self):
+        """Up to chunksize unfinished tasks of the same batch and that batch; waits for the first one."""
+        chunk = []
+        batch = None
+        while not chunk and not self.closed:
+            try:
+                taskIds = [self.tasks.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(taskIds) < self.chunksize:
+                try:
+                    taskIds.append(self.tasks.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                # tasks that were already finished by another worker are not played again
+                taskIds = [taskId for taskId in taskIds if taskId in self.pending]
+                if taskIds:
+                    batch = self.pending[taskIds[0]][2]
+                chunk = [(taskId, self.pending[taskId][0]) for taskId in taskIds if self.pending[taskId][2] == batch]
+                later = [taskId for taskId in taskIds if self.pending[taskId][2] != batch]
+                self.dispatched.update(taskId for taskId, task in chunk)
+            for taskId in later: # tasks of another batch go in one of the next chunks
+                self.tasks.put(taskId)
+        return chunk, batch
+
+    def _serve(self, connection):
+        """Feeds one worker until it is lost or the broker closes."""
+        outstanding = set()
+        try:
+            if self.cancel is not None:
+                self._send(connection, self.cancel)
+            while not self.closed:
+                chunk, batch = self._next_chunk()
+                if not chunk:
+                    break
+                outstanding = set(taskId for taskId, task in chunk)
+                start = time.perf_counter()
+                tasks = pickled([task for taskId, task in chunk])[0]
+                self._send(connection, ('play', [taskId for taskId, task in chunk], tasks, batch))
+                self.telemetry.add_pickling(time.perf_counter() - start) # pickling and sending
+                while outstanding:
+                    if not connection.poll(self.timeout):
+                        raise WorkerLost()
+                    message = connection.recv()
+                    if message[0] == 'results':
+                        if message[3]:
+                            with self.lock:
+                                profiling.merge(self.profile, message[3])
+                        accepted = [] # without the duplicate results of retried tasks
+                        for taskId, result, duration in zip(message[1], pickle.loads(message[2]), message[4][0]):
+                            if self._resolve(taskId, result, duration):
+                                accepted.append((result, duration))
+                            outstanding.discard(taskId)
+                        self.telemetry.add_games([result for result, duration in accepted],
+                                                 ([duration for result, duration in accepted], message[4][1]))
+        except (WorkerLost, OSError, EOFError):
+            self._retry(outstanding)
+        finally:
+            with self.lock:
+                if connection in self.connections:
+                    self.connections.remove(connection)
+            connection.close()
+
+    def _resolve(self, taskId, result, duration):
+        """Sets the result of a task, returns False for a duplicate result of a task that was retried."""
+        with self.lock:
+            entry = self.pending.pop(taskId, None)
+            self.attempts.pop(taskId, None)
+            self.dispatched.discard(taskId)
+            if entry is not None and entry[2] is not None:
+                self.durations[taskId] = duration
+        if entry is None:
+            return False
+        entry[1].set_result(tuple(result))
+        return True
+
+    def _retry(self, taskIds):
+        for taskId in taskIds:
+            with self.lock:
+                if taskId not in self.pending:
+                    continue
+                self.dispatched.discard(taskId)
+                self.attempts[taskId] += 1
+                if self.attempts[taskId] > self.retries:
+                    task, future, batch = self.pending.pop(taskId)
+                    future.set_exception(WorkerLost('task %d lost %d workers' % (taskId, self.attempts[taskId])))
+                    continue
+            self.tasks.put(taskId)
+
+    def submit_game(self, task):
+        """Schedules the game of a single task (see evaluation.game_task), returns a Future."""
+        return self._submit(task)[1]
+
+    def _submit(self, task, batch=None):
+        future = concurrent.futures.Future()
+        with self.lock:
+            taskId = self.nextId
+            self.nextId += 1
+            self.pending[taskId] = (task, future, batch)
+        self.tasks.put(taskId)
+        return taskId, future
+
+    def play(self, tasks, chunksize=None, quorum=None):
+        """Plays the game of every task and returns their (score, lines, pieces, budget hit) in
+        order. The chunk size is the one of the broker. With a quorum, the batch is cancelled on
+        every worker as soon as that fraction of the games is finished, exactly like in
+        EvaluationPool.play: the games that are playing stop with their partial score, those
+        that have not started get the median time of the finished games as their time limit."""
+        batch = self.batches
+        self.batches += 1
+        submitted = [self._submit(task, batch) for task in tasks]
+        futures = [future for taskId, future in submitted]
+        completions = [] # filled in by the threads serving the workers
+        for future in futures:
+            future.add_done_callback(lambda future: completions.append(time.perf_counter()))
+        if quorum is not None and futures:
+            finished = 0
+            for future in concurrent.futures.as_completed(futures):
+                finished += 1
+                if finished >= quorum * len(futures):
+                    break
+            with self.lock:
+                durations = [self.durations[taskId] for taskId, future in submitted if taskId in self.durations]
+                self.cancel = ('cancel', batch, quorum_budget(durations))
+                connections = list(self.connections)
+            for connection in connections:
+                try:
+                    self._send(connection, self.cancel)
+                except (OSError, EOFError): # its thread finds out too and hands its tasks to another worker
+                    pass
+        results = [future.result() for future in futures]
+        with self.lock:
+            for taskId, future in submitted:
+                self.durations.pop(taskId, None)
+        self.telemetry.add_batch(completions, self.workers)
+        return results
+
+    def take_profile(self):
+        """The profiling stats sent by the workers since the last call (empty when they do not profile)."""
+        with self.lock:
+            profile, self.profile = self.profile, {}
+        return profile
+
+    def take_telemetry(self):
+        """What the broker measured since the last call, see telemetry.Telemetry.take. Pickling
+        covers sending the tasks to the workers and the pickling of their results."""
+        return self.telemetry.take(self.workers)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                self._send(connection, ('stop',))
+            except (OSError, EOFError):
+                pass
+        self.listener.close()
+        for process in self.localWorkers:
+            process.join(self.timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Starts worker processes for the broker at HOST:PORT.')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('processes', type=int, nargs='?', default=multiprocessing.cpu_count())
+    parser.add_argument('--profile', action='store_true', help='send the profiling stats of the games along')
+    parser.add_argument('--authkey', help='shared secret of the broker and its workers (default: $%s)' % AUTHKEY_VARIABLE)
+    args = parser.parse_args()
+    authkey = get_authkey(args.authkey) # fails here, and not in every worker, when there is no secret
+    workers = [multiprocessing.Process(target=run_worker, args=((args.host, args.port), authkey, HEARTBEAT, args.profile))
+               for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,110 @@
+"""Checkpoints of optimizer runs, so a run that was killed continues where it stopped.
+
+A checkpoint is a pickled dict with the full state of a run, written after every
+generation (or iteration) to CHECKPOINT_DIR. It is kept out of the *_results
+folders, so the plot scripts never see it. It also holds the configuration of the
+run, and is only continued with the same (see check_config).
+"""
+
+import os
+import pickle
+import random
+
+import numpy as np
+
+CHECKPOINT_DIR = 'checkpoints'
+
+
+def checkpoint_path(name):
+    return os.path.join(CHECKPOINT_DIR, name)
+
+
+def save_checkpoint(name, state):
+    """Writes state under name. The previous checkpoint is only replaced once the new one
+    is completely on disk, so a crash while writing never leaves a broken checkpoint."""
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    path = checkpoint_path(name)
+    with open(path + '.tmp', 'wb') as file:
+        pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(name):
+    """The state saved under name, None when there is no checkpoint."""
+    try:
+        with open(checkpoint_path(name), 'rb') as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def rng_state():
+    """State of the random and numpy.random generators the optimizers draw from."""
+    return random.getstate(), np.random.get_state()
+
+
+def set_rng_state(state):
+    random.setstate(state[0])
+    np.random.set_state(state[1])
+
+
+def check_config(name, state, config):
+    """Raises a ValueError when the checkpoint state of name was saved with another configuration
+    than config (a dict), continuing it would mix two experiments in one run."""
+    saved = state.get('config', {})
+    changed = sorted(key for key in set(saved) | set(config) if saved.get(key, '?') != config.get(key, '?'))
+    if changed:
+        raise ValueError('%s was saved with another configuration (%s), delete it to start the run again'
+                         % (checkpoint_path(name), ', '.join(changed)))
+
+
+def logged_lines(path):
+    """Number of lines of a log file, 0 when there is none."""
+    if not os.path.exists(path):
+        return 0
+    with open(path) as file:
+        return sum(1 for line in file)
+
+
+def log_size(path):
+    """Size of a log file, saved with a checkpoint so lines written after it can be dropped."""
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def truncate_log(path, size):
+    """Drops what was logged after the checkpoint, those generations are run again."""
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, 'r+') as file:
+            file.truncate(size)
+
+
+def save_run(name, state, config, logPaths, done):
+    """Saves the fields of a run (a dict) under name, with its configuration, whether it is done
+    and the sizes of its log files, the first of which is the text log."""
+    state = dict(state, config=config, done=done, logSizes=[log_size(path) for path in logPaths])
+    save_checkpoint(name, state)
+
+
+def restore_run(name, config, logPaths, complete=None):
+    """The fields saved by save_run under name, None when there is no checkpoint. Lines logged after
+    the checkpoint belong to generations that are run again and are dropped.
+
+    complete is the number of lines of a finished text log, None when the run does not log. Without
+    a checkpoint (e.g. a run from before checkpoints) a complete log gives {'done': True, 'logComplete':
+    True}, an incomplete one is emptied, so the run is started again instead of getting a second run
+    appended.
+    """
+    state = load_checkpoint(name)
+    if state is None:
+        if complete is not None:
+            if logged_lines(logPaths[0]) >= complete:
+                return {'done': True, 'logComplete': True}
+            for path in logPaths:
+                truncate_log(path, 0)
+        return None
+    check_config(name, state, config)
+    for path, size in zip(logPaths, state['logSizes']):
+        truncate_log(path, size)
+    return state
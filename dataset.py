@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""Placement datasets: the candidate placements of recorded moves, for scoring weights offline.
+
+For every move of a game the dataset keeps the feature vectors of all valid placements
+(as AI.placement_features computes them, the batched equivalent of AI.score_board) and
+which of them was played. agreement then tells, for a whole batch of weight vectors at
+once, how often each of them would have chosen the recorded placement: a proxy fitness
+that costs microseconds per move instead of full games, to screen many candidates
+before they are played.
+
+A dataset is a folder with three flat binary files that are only ever appended to, so
+extraction can be continued and the arrays are read back memory-mapped:
+
+    features.bin   FEATURE_DTYPE, one row of NUM_FEATURES per candidate placement
+    counts.bin     MOVE_DTYPE, number of candidates per move
+    chosen.bin     MOVE_DTYPE, index (within its move) of the candidate that was played
+
+    python dataset.py FOLDER [GAMES] [PIECELIMIT]      # records GAMES seeded games of the default AI
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from game_board import Board
+from players import AI
+
+NUM_FEATURES = 8 # in the order of the weights of the AI
+FEATURE_DTYPE = np.int16 # feature values of a 10x20 board are far below 2**15
+MOVE_DTYPE = np.int32
+CHUNK = 1 << 22 # most (candidate, weight vector) scores agreement computes at once
+
+
+class DatasetWriter(object):
+    """Appends moves to the dataset in folder (created when needed)."""
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.features = open(os.path.join(folder, 'features.bin'), 'ab')
+        self.counts = open(os.path.join(folder, 'counts.bin'), 'ab')
+        self.chosen = open(os.path.join(folder, 'chosen.bin'), 'ab')
+        self.moves = 0
+
+    def add_move(self, features, chosen):
+        """features is the (candidates x NUM_FEATURES) matrix of a move, chosen the row that was played."""
+        self.features.write(np.ascontiguousarray(features, dtype=FEATURE_DTYPE).tobytes())
+        self.counts.write(np.array([len(features)], dtype=MOVE_DTYPE).tobytes())
+        self.chosen.write(np.array([chosen], dtype=MOVE_DTYPE).tobytes())
+        self.moves += 1
+
+    def add_game(self, weights=None, seed=None, pieceLimit=-1, depth=1):
+        """Plays a game with the AI and records every move it makes. Returns (score, moves recorded)."""
+        player = AI(weights, depth=depth)
+        moves = 0
+        board = Board(pieceLimit=pieceLimit, seed=seed)
+        board.next_tetromino()
+        playing = board.spawn_shape()
+        while playing:
+            # the features are taken before get_moves, which moves the falling shape around
+            placements, features = player.placement_features(board)
+            row, column, orientation = player.get_moves(board, None)
+            if row is None:
+                break
+            self.add_move(features, placements.index((row, column, orientation)))
+            moves += 1
+            playing = board.place_falling_shape(column, row, orientation)
+        return board.score, moves
+
+    def add_trace(self, trace):
+        """Records every move of a replay (see replay.Trace), e.g. of an elite of an optimizer run."""
+        player = AI()
+        for piece, board in enumerate(trace.boards()):
+            if piece == len(trace):
+                break
+            orientation, column = trace.move(piece)
+            placements, features = player.placement_features(board)
+            played = [i for i, (r, c, o) in enumerate(placements)
+                      if o == orientation and c + board.falling_shape.orientations[o].min_column == column]
+            self.add_move(features, played[0])
+
+    def close(self):
+        for file in (self.features, self.counts, self.chosen):
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PlacementDataset(object):
+    """The moves of a dataset folder, memory-mapped (read only)."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.counts = self._map('counts.bin', MOVE_DTYPE)
+        self.chosen = self._map('chosen.bin', MOVE_DTYPE)
+        self.features = self._map('features.bin', FEATURE_DTYPE).reshape(-1, NUM_FEATURES)
+        self.starts = np.zeros(len(self.counts) + 1, dtype=np.int64) # row of the first candidate of every move
+        np.cumsum(self.counts, out=self.starts[1:])
+        if self.starts[-1] != len(self.features):
+            raise ValueError('%s is not a complete dataset' % folder)
+
+    def _map(self, name, dtype):
+        path = os.path.join(self.folder, name)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self.counts)
+
+
+def choices(dataset, weights, start=0, stop=None):
+    """Index of the candidate every weight vector picks in each move from start to stop, as a
+    (moves x weight vectors) array. Like AI.get_moves the first of equally good candidates
+    is picked, and the scores are accumulated feature by feature like AI.score_features, so
+    the weights the dataset was recorded with pick exactly what was played."""
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+    stop = len(dataset) if stop is None else stop
+    first, last = dataset.starts[start], dataset.starts[stop]
+    features = np.asarray(dataset.features[first:last], dtype=np.float64)
+    scores = features[:, :1] * weights[:, 0]
+    for i in range(1, NUM_FEATURES):
+        scores += features[:, i:i + 1] * weights[:, i]
+    starts = dataset.starts[start:stop] - first
+    best = np.maximum.reduceat(scores, starts, axis=0)
+    rows = np.arange(len(scores))[:, None]
+    # rows of the best candidates, every other row counts as past the end; the smallest is the first best
+    isBest = scores == np.repeat(best, dataset.counts[start:stop], axis=0)
+    picked = np.minimum.reduceat(np.where(isBest, rows, len(scores)), starts, axis=0)
+    return picked - starts[:, None]
+
+
+def agreement(dataset, weights, chunk=CHUNK):
+    """Fraction of the moves of the dataset in which every weight vector (a row of weights)
+    picks the placement that was played, as an array with one value per weight vector.
+    Moves are scored in batches of at most chunk (candidate, weight vector) pairs."""
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+    agreed = np.zeros(len(weights), dtype=np.int64)
+    moves = len(dataset)
+    start = 0
+    while start < moves:
+        # as many moves as fit in the chunk, but at least one
+        limit = dataset.starts[start] + max(1, chunk // len(weights))
+        stop = max(start + 1, int(np.searchsorted(dataset.starts, limit, side='right')) - 1)
+        stop = min(stop, moves)
+        picked = choices(dataset, weights, start, stop)
+        agreed += (picked == np.asarray(dataset.chosen[start:stop])[:, None]).sum(axis=0)
+        start = stop
+    return agreed / moves if moves else np.zeros(len(weights))
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1]
+    games = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    pieceLimit = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    with DatasetWriter(folder) as writer:
+        for seed in range(games):
+            score, moves = writer.add_game(seed=seed, pieceLimit=pieceLimit)
+            print('game', seed, 'score', score, 'moves', moves)
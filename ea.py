@@ -1,18 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
-from game import Game
-
-from players import AI
+from simulator import simulate
 
 PIECELIMIT = -1 # Maximum number of pieces in a game before game over. Set to -1 for unlimited
 
 # Get score from weights
 def runTetris(weights = None):
-    player = AI(weights)
-    game = Game(player)
-    game.new_game(pieceLimit = PIECELIMIT)
-    return game.run_game()
+    score, lines, pieces, budgetHit = simulate(weights, PIECELIMIT)
+    return score
 
 
 def geneticAlgorithm():
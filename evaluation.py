@@ -0,0 +1,426 @@
+"""Fitness evaluation infrastructure shared by the optimizers."""
+
+import collections
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import pickle
+import shelve
+import statistics
+import threading
+import time
+
+import profiling
+from telemetry import Telemetry, pickled
+
+from game_board import NUM_COLUMNS
+from pieces import TETROMINOES
+from players import BEAM_WIDTH
+from population_simulator import simulate_population
+from replay import TraceRecorder
+from simulator import simulate # imported here so that every worker has the game loaded before its first task
+
+
+_cancelled = None # shared with the pool: the number of the last cancelled batch of games, see EvaluationPool.play
+_budget = None # shared with the pool: seconds for the games of the cancelled batch that had not started yet
+
+
+def init_worker(affinity=None, counter=None, cancelled=None, budget=None, profile=False):
+    """Runs once in every worker process (of a pool or of a broker), before its first task."""
+    global _cancelled, _budget
+    _cancelled = cancelled
+    _budget = budget
+    if profile:
+        profiling.enable()
+    if affinity and hasattr(os, 'sched_setaffinity'):
+        # pin the workers to the given CPUs, one after the other
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        os.sched_setaffinity(0, {affinity[index % len(affinity)]})
+    # fill the placement tables now, so the first game does not pay for it
+    for tetromino in TETROMINOES:
+        tetromino.placements(NUM_COLUMNS)
+
+
+def _cancellation(batch, timeLimit):
+    """(stop, time limit) of a game of batch that starts now: while the batch is not cancelled
+    the game stops when it is, once it is the game gets the budget the pool set instead."""
+    if batch is None or _cancelled is None:
+        return None, timeLimit
+    if _cancelled.value >= batch:
+        return None, min(timeLimit, _budget.value) if timeLimit is not None else _budget.value
+    return (lambda: _cancelled.value >= batch), timeLimit
+
+
+def play_games(tasks, batch=None):
+    """Worker side of EvaluationPool.play: plays a chunk of games.
+
+    Every task is a tuple (weights, pieceLimit, seed, timeLimit, trace, depth, beamWidth)
+    with the weights as a plain tuple of floats; returns a list with a tuple (score, lines, pieces,
+    budget hit) per task. Once the batch is cancelled, the games that are still
+    playing stop and return their partial score; the games that had not started yet
+    are played with the budget the pool set for them (a time limit, not a score of 0).
+    Games with a trace path write their replay (see replay.py) there.
+    """
+    results = []
+    for weights, pieceLimit, seed, timeLimit, trace, depth, beamWidth in tasks:
+        stop, timeLimit = _cancellation(batch, timeLimit)
+        recorder = TraceRecorder(seed) if trace else None
+        results.append(simulate(weights, pieceLimit, seed, depth, beamWidth, timeLimit, stop, recorder))
+        if recorder is not None:
+            recorder.save(trace)
+    return results
+
+
+def play_population(tasks, batch=None):
+    """Like play_games, but the games are played in lock-step, see population_simulator.
+    Only the greedy AI without replays is simulated that way; games with a lookahead
+    depth or a trace path are played one by one with play_games."""
+    lockstep = [i for i, task in enumerate(tasks) if task[5] == 1 and not task[4]]
+    results = [None] * len(tasks)
+    if lockstep:
+        stop = _cancellation(batch, None)[0]
+        timeLimits = [_cancellation(batch, tasks[i][3])[1] for i in lockstep]
+        games = simulate_population([tasks[i][0] for i in lockstep], [tasks[i][1] for i in lockstep],
+                                    [tasks[i][2] for i in lockstep], timeLimits, stop)
+        for i, result in zip(lockstep, games):
+            results[i] = result
+    others = [i for i in range(len(tasks)) if results[i] is None]
+    for i, result in zip(others, play_games([tasks[i] for i in others], batch)):
+        results[i] = result
+    return results
+
+
+def play_chunk(tasks, batch=None, lockstep=False):
+    """play_games (play_population with lockstep), with what the pool reports about it: returns
+    (results, profiling stats, timing). tasks and results are pickled (see telemetry.pickled).
+    The stats are those of the worker since its last chunk (None when profiling is off, see
+    EvaluationPool(profile=True)), timing is (duration of every game, seconds to pickle the
+    results). Games played in lock-step share the time of the chunk."""
+    tasks = pickle.loads(tasks)
+    results = []
+    durations = []
+    if lockstep:
+        start = time.perf_counter()
+        results = play_population(tasks, batch)
+        durations = [(time.perf_counter() - start) / max(1, len(tasks))] * len(tasks)
+    else:
+        for task in tasks:
+            start = time.perf_counter()
+            results.extend(play_games([task], batch))
+            durations.append(time.perf_counter() - start)
+    stats = profiling.collect() if profiling.enabled() else None
+    results, seconds = pickled(results)
+    return results, stats, (durations, seconds)
+
+
+def play_game(task):
+    """Plays the game of a single task, see play_games."""
+    return play_games([task])[0]
+
+
+def game_task(weights, pieceLimit=-1, seed=None, timeLimit=None, trace=None, depth=1, beamWidth=BEAM_WIDTH):
+    """Compact task for play_games: nothing but the numbers a game needs.
+    timeLimit is an optional budget in seconds, after which the game stops with its partial score.
+    trace is an optional file name for a replay of the game; the worker writes it, so with
+    remote workers it has to be on storage shared with them. depth and beamWidth set the
+    search of the AI, see simulator.simulate."""
+    return (tuple(float(w) for w in weights), pieceLimit, seed, timeLimit, trace, depth, beamWidth)
+
+
+def is_final(result, pieceLimit):
+    """Whether a game result is the score of its piece limit, and not a partial score of a game
+    that was stopped by its time limit or cancelled."""
+    score, lines, pieces, budgetHit = result
+    return not budgetHit or pieces == pieceLimit
+
+
+def quorum_budget(durations):
+    """Time limit of the games that had not started when the quorum of their batch was reached:
+    the median duration of the finished games, so they are cut where a typical game ended instead
+    of being left out (or scored 0) because of their place in the queue."""
+    return statistics.median(durations)
+
+
+class EvaluationPool(object):
+    """A long-lived pool of worker processes for playing games.
+
+    Create it once per experiment and hand it to every optimizer run (SimpleEA, NES),
+    so the worker processes are started (and their imports warmed up) only once.
+    workers is the number of processes (None for one per CPU), affinity an optional
+    list of CPU ids; every worker is then pinned to one of those CPUs in turn.
+    With profile, the workers count the calls and time of the AI hot path (see profiling)
+    and send them back with their results; take_profile returns the sum of them.
+    take_telemetry summarizes how busy the workers were, see telemetry.Telemetry.
+    With lockstep, play gives every worker one chunk (four with a quorum, which can only
+    count whole chunks) and the worker plays its games
+    together with population_simulator (see play_population), which saves most of the
+    interpreter overhead per piece; single games (submit_game) are played as usual.
+    """
+
+    def __init__(self, workers=None, affinity=None, profile=False, lockstep=False):
+        self.workers = workers or (len(affinity) if affinity else os.cpu_count())
+        self.affinity = list(affinity) if affinity else None
+        self.cancelled = multiprocessing.Value('l', -1, lock=False) # read by the workers between two pieces
+        self.budget = multiprocessing.Value('d', 0.0, lock=False) # see play_games, set before cancelled
+        self.batches = 0
+        self.profiling = profile
+        self.lockstep = lockstep
+        self.profile = {} # stats sent back by the workers since the last take_profile
+        self.profileLock = threading.Lock() # stats of single games are added by the threads of the executor
+        self.telemetry = Telemetry()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_worker,
+            initargs=(self.affinity, multiprocessing.Value('i', 0), self.cancelled, self.budget, profile))
+
+    def play(self, tasks, chunksize=None, quorum=None):
+        """Plays the game of every task (see game_task) and returns their (score, lines, pieces,
+        budget hit) in the same order. The tasks are sent in chunks, so one round trip to a worker
+        covers many games; by default every worker gets about four chunks (one with lockstep and
+        no quorum: the fewer chunks, the more games are played in lock-step).
+        With a quorum (a fraction of the tasks), the batch is cancelled as soon as that many games
+        are finished: the games that are playing stop and return their partial score with budget
+        hit set, the games that have not started yet get the median time of the finished games
+        (see quorum_budget) as their time limit."""
+        tasks = list(tasks)
+        batch = self.batches
+        self.batches += 1
+        # finished games only come back with their chunk, a quorum needs several per worker to act in time
+        chunksPerWorker = 1.0 if self.lockstep and quorum is None else 4.0
+        chunksize = chunksize or max(1, int(math.ceil(len(tasks) / (self.workers * chunksPerWorker))))
+        chunks = [pickled(tasks[i:i + chunksize]) for i in range(0, len(tasks), chunksize)]
+        self.telemetry.add_pickling(sum(seconds for chunk, seconds in chunks))
+        futures = [self.executor.submit(play_chunk, chunk, batch, self.lockstep) for chunk, seconds in chunks]
+        completions = [] # filled in by the threads of the executor
+        for future in futures:
+            future.add_done_callback(lambda future: completions.append(time.perf_counter()))
+        if quorum is not None:
+            durations = []
+            for future in concurrent.futures.as_completed(futures):
+                durations.extend(future.result()[2][0])
+                if len(durations) >= quorum * len(tasks):
+                    self.budget.value = quorum_budget(durations)
+                    self.cancelled.value = batch
+                    break
+        results = []
+        for future in futures:
+            results.extend(self._add_chunk(future.result()))
+        self.telemetry.add_batch(completions, self.workers)
+        return results
+
+    def submit_game(self, task):
+        """Schedules the game of a single task (see game_task), returns a Future of its
+        (score, lines, pieces, budget hit). For optimizers that do not wait for a whole batch."""
+        future = concurrent.futures.Future()
+
+        def done(chunk):
+            try:
+                results = self._add_chunk(chunk.result())
+            except Exception as error:
+                future.set_exception(error)
+                return
+            future.set_result(results[0])
+        chunk, seconds = pickled([task])
+        self.telemetry.add_pickling(seconds)
+        self.executor.submit(play_chunk, chunk).add_done_callback(done)
+        return future
+
+    def _add_chunk(self, chunk):
+        """Books the profiling stats and timing of a chunk from play_chunk, returns its results."""
+        results, stats, timing = chunk
+        results = pickle.loads(results)
+        if stats:
+            with self.profileLock:
+                profiling.merge(self.profile, stats)
+        self.telemetry.add_games(results, timing)
+        return results
+
+    def take_profile(self):
+        """The profiling stats of all games played since the last call (empty without profile)."""
+        with self.profileLock:
+            profile, self.profile = self.profile, {}
+        return profile
+
+    def take_telemetry(self):
+        """What the pool measured since the last call, see telemetry.Telemetry.take."""
+        return self.telemetry.take(self.workers)
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) on a worker, returns a Future."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def successive_halving(pool, candidates, rungs, keep=0.5, seed=None, timeLimit=None, quorum=None, depth=1,
+                       beamWidth=BEAM_WIDTH):
+    """Multi-fidelity fitness of a list of weight vectors, played on pool.
+
+    All candidates play a game of rungs[0] pieces, the best keep fraction of them
+    plays a game of rungs[1] pieces, and so on; only the last survivors play rungs[-1]
+    pieces (-1 for a full game). Every candidate gets the score of the last game it
+    played. With a seed these games are prefixes of each other, so a candidate that
+    was dropped never outranks one that was promoted. timeLimit and quorum bound every
+    game and every rung like in pool.play, depth and beamWidth are those of game_task.
+    Returns a list with a tuple (score, final) per candidate, final is True when the
+    score is that of a complete game of the last rung (or of a game that was over before
+    its limit), and not a partial score of a game that was stopped.
+    """
+    scores = [0] * len(candidates)
+    final = [False] * len(candidates)
+    alive = list(range(len(candidates)))
+    for rung, pieceLimit in enumerate(rungs):
+        if rung > 0:
+            alive = sorted(alive, key=lambda i: (-scores[i], i))
+            alive = alive[:max(1, int(math.ceil(len(alive) * keep)))]
+        # candidates whose game was already over keep their score, there is nothing left to play
+        playing = [i for i in alive if not final[i]]
+        tasks = [game_task(candidates[i], pieceLimit, seed, timeLimit, depth=depth, beamWidth=beamWidth) for i in playing]
+        results = pool.play(tasks, quorum=quorum)
+        for i, result in zip(playing, results):
+            scores[i] = result[0]
+            final[i] = is_final(result, pieceLimit) if rung == len(rungs) - 1 else not result[3]
+    return list(zip(scores, final))
+
+
+def adaptive_fitness(pool, candidates, cutoff=None, minGames=3, maxGames=20, z=1.96, tolerance=0.05,
+                     seed=None, pieceLimit=-1, timeLimit=None, quorum=None, depth=1, beamWidth=BEAM_WIDTH):
+    """Mean score of every weight vector over as many games as its ranking needs.
+
+    cutoff is an optional function that gets the current means of all candidates and
+    returns the score the selection depends on (e.g. the score of the last elite).
+    Every candidate plays at least minGames games and keeps playing until the
+    confidence interval (mean +- z standard errors) of its mean no longer contains the
+    cutoff or is narrower than tolerance times the cutoff (its own mean without a
+    cutoff), or until it played maxGames games. Game k of every candidate uses seed + k,
+    so the candidates are compared on the same piece sequences. timeLimit and quorum
+    bound every game and every round of games like in pool.play, depth and beamWidth
+    are those of game_task.
+    Returns a list with a tuple (mean, standard error, games, final) per candidate, final
+    is False when one of its games was stopped and only has a partial score.
+    """
+    scores = [[] for _ in candidates]
+    final = [True] * len(candidates)
+    playing = list(range(len(candidates)))
+    minGames = min(minGames, maxGames)
+
+    def estimate(i):
+        n = len(scores[i])
+        mean = sum(scores[i]) / n
+        if n < 2:
+            return mean, float('inf')
+        variance = sum((s - mean) ** 2 for s in scores[i]) / (n - 1)
+        return mean, math.sqrt(variance / n)
+
+    while playing:
+        # one more game for every candidate whose ranking is still unclear, all in parallel
+        tasks = []
+        for i in playing:
+            gameSeed = seed + len(scores[i]) if seed is not None else None
+            tasks.append(game_task(candidates[i], pieceLimit, gameSeed, timeLimit, depth=depth, beamWidth=beamWidth))
+        for i, result in zip(playing, pool.play(tasks, quorum=quorum)):
+            scores[i].append(result[0])
+            final[i] = final[i] and is_final(result, pieceLimit)
+        means = [estimate(i)[0] for i in range(len(candidates))]
+        threshold = cutoff(means) if cutoff is not None else None
+        stillPlaying = []
+        for i in playing:
+            n = len(scores[i])
+            if n < minGames:
+                stillPlaying.append(i)
+                continue
+            mean, stderr = estimate(i)
+            reference = threshold if threshold is not None else mean
+            decided = threshold is not None and abs(mean - threshold) > z * stderr
+            narrow = z * stderr <= tolerance * abs(reference)
+            if n < maxGames and not decided and not narrow:
+                stillPlaying.append(i)
+        playing = stillPlaying
+    return [estimate(i) + (len(scores[i]), final[i]) for i in range(len(candidates))]
+
+
+class FitnessCache(object):
+    """Remembers the fitness of weight vectors, so unchanged individuals are not replayed.
+
+    Entries are keyed by (normalized weights, seed, piece limit) and hold the average
+    score and the number of games it averages. At most size entries are kept in memory,
+    the least recently used are dropped first. With a path the entries are also kept in
+    an on-disk archive (a shelve database) that is shared by all runs and experiments
+    using the same path. variant is added to every key, e.g. the search settings of the AI
+    (depth, beam width), so an archive shared by experiments with different settings keeps
+    their fitnesses apart.
+    """
+
+    def __init__(self, size=10000, path=None, variant=None):
+        self.size = size
+        self.path = path
+        self.variant = variant
+        self.entries = collections.OrderedDict() # key -> [average score, games]
+        self.archive = shelve.open(path) if path else None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, weights, seed, pieceLimit):
+        # the AI only compares scores, so the length of the weight vector does not matter;
+        # rounding merges vectors that only differ by floating point noise
+        factor = max(abs(w) for w in weights) or 1
+        key = (tuple(round(w / factor, 10) for w in weights), seed, pieceLimit)
+        return key if self.variant is None else key + (self.variant,)
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None and self.archive is not None:
+            entry = self.archive.get(repr(key))
+            if entry is not None:
+                self._store(key, entry)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, weights, seed=None, pieceLimit=-1):
+        """The average score of the weights, or None if they were never evaluated."""
+        entry = self._lookup(self.key(weights, seed, pieceLimit))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def games(self, weights, seed=None, pieceLimit=-1):
+        """Number of games behind the cached score of the weights."""
+        entry = self._lookup(self.key(weights, seed, pieceLimit))
+        return entry[1] if entry is not None else 0
+
+    def put(self, weights, seed, pieceLimit, score, games=1):
+        """Adds the average score of games new games, merging it with what is already known."""
+        key = self.key(weights, seed, pieceLimit)
+        entry = self._lookup(key)
+        if entry is not None:
+            total = entry[1] + games
+            score = (entry[0] * entry[1] + score * games) / total
+            games = total
+        entry = [score, games]
+        self._store(key, entry)
+        if self.archive is not None:
+            self.archive[repr(key)] = entry
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
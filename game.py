@@ -48,6 +48,7 @@ class Game(object):
         self.last_tick = None
         self.board = Board(pieceLimit=pieceLimit)
         if self.displayScreen:
+            signal.signal(signal.SIGINT, signal_handler) # restore the terminal on ctrl-c
             self.board_drawer = BoardDrawer()
             self.board_drawer.clear_score()
         self.board.start_game()
@@ -156,7 +157,5 @@ def signal_handler(signal, frame):
         pass
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
-
 if __name__ == '__main__':
     main()
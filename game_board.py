@@ -1,7 +1,10 @@
 import copy
-import curses
 import math
-import random
+
+try:
+    import curses
+except ImportError: # e.g. on Windows, only headless games (see simulator.py) can be played then
+    curses = None
 
 from pieces import *
 
@@ -20,41 +23,78 @@ BORDER_WIDTH = 1
 
 POINTS_PER_LINE = [0, 40, 100, 300, 1200] # [0,1,2,3,4]
 
+COLOR_BITS = 4 # bits used per cell in a packed row of colours
+COLOR_MASK = (1 << COLOR_BITS) - 1
+
+
+def popcount(mask):
+    """Number of set bits (occupied cells) in a row mask."""
+    return bin(mask).count('1')
+
 class Board(object):
-    """Maintains the entire state of the game."""
-    def __init__(self, columns=None, rows=None, pieceLimit=-1):
+    """Maintains the entire state of the game.
+
+    Settled cells are stored as one integer bitmask per row (bit c set means
+    column c is occupied), so collision, settling and line detection are a
+    handful of bitwise operations. The colour of every settled cell is kept
+    separately in `colors`, packed COLOR_BITS per column into one integer per
+    row, and is only needed for rendering.
+
+    Column heights, per-row fill counts and per-column hole statistics are
+    kept up to date while pieces settle and lines clear, so the features of
+    the AI can read them instead of scanning the board.
+    """
+    def __init__(self, columns=None, rows=None, pieceLimit=-1, seed=None):
         self.pieceLimit = pieceLimit
         self.num_rows = rows or NUM_ROWS
         self.num_columns = columns or NUM_COLUMNS
-        self.array = [[None for _ in range(self.num_columns)] for _ in range(self.num_rows)]
+        self.full_row = (1 << self.num_columns) - 1
+        self.rows = [0] * self.num_rows
+        self.colors = [0] * self.num_rows
+        self.row_fill = [0] * self.num_rows # number of occupied cells in each row
+        self.full_rows = 0 # rows that are completely filled (only on boards that are not cleared)
+        self.heights = [0] * self.num_columns # height of the highest block of each column
+        self.column_holes = [0] * self.num_columns # empty cells with a block directly above, per column
+        self.hole_row_sum = [0] * self.num_columns # sum of the row indices of those cells, per column
         self.falling_shape = None
         self.next_shape = None
         self.score = 0
-        self.bag = [SquareShape(PREVIEW_COLUMN, PREVIEW_ROW, 6, 0), 
-                    LineShape(PREVIEW_COLUMN, PREVIEW_ROW, 5, 1),
-                    SShape(PREVIEW_COLUMN, PREVIEW_ROW, 3, 1),
-                    LShape(PREVIEW_COLUMN, PREVIEW_ROW, 6, 3),
-                    TShape(PREVIEW_COLUMN, PREVIEW_ROW, 4, 0),
-                    ZShape(PREVIEW_COLUMN, PREVIEW_ROW, 1, 1),
-                    JShape(PREVIEW_COLUMN, PREVIEW_ROW, 2, 1)] # bag of tetrominos
-        self.shuffle_bag()
-        self.bagNextIndex = 0
+        self.lines_cleared = 0
+        self.last_clear = None # LineClear of the most recent line clear
+        self.sequence = PieceSequence(seed) # 7-bag of tetrominos, the shapes are only created when drawn
 
 
     def deepBoardCopy(self):
-        newBoard = Board(pieceLimit=self.pieceLimit)
-        newBoard.falling_shape = self.falling_shape
-        newBoard.next_shape = self.next_shape
-        for r in range(self.num_rows):
-            for c in range(self.num_columns):
-                if self.array[r][c] is not None:
-                    newBoard.array[r][c] = self.array[r][c].getDeepCopy()
+        """Independent copy of the board, without building (or shuffling) a new bag.
+        The falling and next shape are shared; the piece sequence is copied and draws the
+        same pieces as the original without advancing it (see PieceSequence.copy)."""
+        newBoard = Board.__new__(Board)
+        newBoard.__dict__.update(self.__dict__)
+        newBoard.rows = self.rows[:]
+        newBoard.colors = self.colors[:]
+        newBoard.row_fill = self.row_fill[:]
+        newBoard.heights = self.heights[:]
+        newBoard.column_holes = self.column_holes[:]
+        newBoard.hole_row_sum = self.hole_row_sum[:]
+        newBoard.sequence = self.sequence.copy()
         return newBoard
 
+    @property
+    def array(self):
+        """Grid of `Block`s (or None) built from the bitmasks. Only meant for
+        debugging and legacy callers, the engine itself never uses it."""
+        return [[Block(r, c, self.color_at(r, c)) if mask >> c & 1 else None
+                 for c in range(self.num_columns)]
+                for r, mask in enumerate(self.rows)]
+
+    def color_at(self, row, column):
+        """Colour of the settled cell, 0 when the cell is empty."""
+        return self.colors[row] >> (column * COLOR_BITS) & COLOR_MASK
+
     def printSelf(self):
-        for row in self.array:
-            for cell in row:
-                if cell:
+        for mask in self.rows:
+            for c in range(self.num_columns):
+                if mask >> c & 1:
                     print("[]", end='')
                 else:
                     print("__", end='')
@@ -62,29 +102,11 @@ class Board(object):
 
 
     def shuffle_bag(self):
-        random.shuffle(self.bag)
+        self.sequence.shuffle()
 
     def next_tetromino(self):
-
-        if type(self.bag[self.bagNextIndex]) is SquareShape:
-            self.next_shape = SquareShape(PREVIEW_COLUMN, PREVIEW_ROW, 6, 0)
-        if type(self.bag[self.bagNextIndex]) is LineShape:
-            self.next_shape = LineShape(PREVIEW_COLUMN, PREVIEW_ROW, 5, 1)
-        if type(self.bag[self.bagNextIndex]) is SShape:
-            self.next_shape = SShape(PREVIEW_COLUMN, PREVIEW_ROW, 3, 1)
-        if type(self.bag[self.bagNextIndex]) is LShape:
-            self.next_shape = LShape(PREVIEW_COLUMN, PREVIEW_ROW, 6, 3)
-        if type(self.bag[self.bagNextIndex]) is TShape:
-            self.next_shape = TShape(PREVIEW_COLUMN, PREVIEW_ROW, 4, 0)
-        if type(self.bag[self.bagNextIndex]) is ZShape:
-            self.next_shape = ZShape(PREVIEW_COLUMN, PREVIEW_ROW, 1, 1)
-        if type(self.bag[self.bagNextIndex]) is JShape:
-            self.next_shape = JShape(PREVIEW_COLUMN, PREVIEW_ROW, 2, 1)
-        
-        self.bagNextIndex += 1
-        if self.bagNextIndex == 7:
-            self.bagNextIndex = 0
-            self.shuffle_bag()
+        tetromino = next(self.sequence)
+        self.next_shape = tetromino(PREVIEW_COLUMN, PREVIEW_ROW, tetromino.default_color, tetromino.default_orientation)
 
     def start_game(self):
         self.score = 0
@@ -96,6 +118,12 @@ class Board(object):
         raise GameOverError(score=self.score)
 
     def new_shape(self):
+        if not self.spawn_shape():
+            self.end_game()
+
+    def spawn_shape(self):
+        """Brings the next shape into play. Returns False when the game is over
+        instead of raising a GameOverError."""
         self.falling_shape = self.next_shape
         self.falling_shape.move_to(STARTING_COLUMN, STARTING_ROW)
         self.next_tetromino()
@@ -103,38 +131,46 @@ class Board(object):
             self.next_shape = self.falling_shape
             self.falling_shape = None
             self.next_shape.move_to(PREVIEW_COLUMN, PREVIEW_ROW)
-            self.end_game()
+            return False
         self.pieceLimit -= 1
+        return True
+
+    def place_falling_shape(self, column, row, orientation):
+        """Puts the falling shape straight at its final position, settles it and
+        brings in the next shape. Returns False when the game is over."""
+        shape = self.falling_shape
+        shape.orientation = orientation
+        shape.move_to(column, row)
+        if self.shape_cannot_be_placed(shape):
+            return False
+        self._settle_shape(shape)
+        self.falling_shape = None
+        return self.spawn_shape()
 
     def remove_completed_lines(self):
-        rows_removed = []
-        lowest_row_removed = 0
-        for row in self.array:
-            if all(row):
-                lowest_row_removed = max(lowest_row_removed, row[0].row_position)
-                removedRow = []
-                for block in row:
-                    removedRow.append(block.getDeepCopy())
-                rows_removed.append(removedRow)
-                #rows_removed.append(copy.deepcopy(row))
-                for block in row:
-                    self.array[block.row_position][block.column_position] = None
-        if len(rows_removed) > 0:
-            self.score += POINTS_PER_LINE[len(rows_removed)]
-
-            for column_index in range(0, NUM_COLUMNS):
-                for row_index in range(lowest_row_removed, 0, -1):
-                    block = self.array[row_index][column_index]
-                    if block:
-                        # number of rows removed that were below this one
-                        distance_to_drop = len(
-                            [row for row in rows_removed if
-                             row[0].row_position > block.row_position]
-                        )
-                        new_row_index = row_index + distance_to_drop
-                        self.array[row_index][column_index] = None
-                        self.array[new_row_index][column_index] = block
-                        block.row_position = new_row_index
+        """Removes all full rows and drops the rows above them. Returns a LineClear
+        with the removed rows and the points awarded, or None when no row was full."""
+        if not self.full_rows: # maintained while placing, so no scan is needed to know this
+            return None
+        num_columns = self.num_columns
+        cleared = [r for r, fill in enumerate(self.row_fill) if fill == num_columns]
+        # compact the rows: delete the full ones (lowest first, so the indices stay valid) and add empty rows on top
+        for r in reversed(cleared):
+            del self.rows[r]
+            del self.colors[r]
+            del self.row_fill[r]
+        lines_removed = len(cleared)
+        self.rows[:0] = [0] * lines_removed
+        self.colors[:0] = [0] * lines_removed
+        self.row_fill[:0] = [0] * lines_removed
+        self.full_rows = 0
+        self._recompute_columns()
+
+        points = POINTS_PER_LINE[lines_removed]
+        self.score += points
+        self.lines_cleared += lines_removed
+        self.last_clear = LineClear(cleared, points)
+        return self.last_clear
 
     def settle_falilng_shape(self):
         """Resolves the current falling shape."""
@@ -144,17 +180,118 @@ class Board(object):
             self.new_shape()
 
     def _settle_shape(self, shape):
-        """Adds shape to settled pieces array."""
+        """Adds shape to settled pieces array. Returns the LineClear of the completed lines (or None)."""
         if shape:
-            for block in shape.blocks:
-                self.array[block.row_position][block.column_position] = block
-        self.remove_completed_lines()
+            self._place_blocks(shape)
+        return self.remove_completed_lines()
 
     def _settle_shape_no_clear(self, shape):
         """Adds shape to settled pieces array. does not remove completed lines"""
         if shape:
-            for block in shape.blocks:
-                self.array[block.row_position][block.column_position] = block
+            self._place_blocks(shape)
+
+    def apply_placement(self, shape):
+        """Trial placement: adds shape to the settled cells without clearing lines
+        (and without colours). Returns a Placement that reports the affected cells
+        and that undo_placement uses to restore the board exactly."""
+        geometry = shape.orientations[shape.orientation]
+        column = shape.column_position + geometry.min_column
+        end = column + geometry.width
+        placement = Placement(shape.row_position, column, geometry, self.full_rows, self.heights[column:end],
+                              self.column_holes[column:end], self.hole_row_sum[column:end])
+        self._place_cells(geometry, shape.row_position, column)
+        return placement
+
+    def undo_placement(self, placement):
+        """Takes back a trial placement made by apply_placement."""
+        geometry = placement.geometry
+        column = placement.column
+        rows = self.rows
+        row_fill = self.row_fill
+        for row_offset, mask in geometry.row_masks:
+            rows[placement.row + row_offset] &= ~(mask << column)
+            row_fill[placement.row + row_offset] -= popcount(mask)
+        end = column + geometry.width
+        self.full_rows = placement.full_rows
+        self.heights[column:end] = placement.heights
+        self.column_holes[column:end] = placement.column_holes
+        self.hole_row_sum[column:end] = placement.hole_row_sum
+
+    def _place_blocks(self, shape):
+        geometry = shape.orientations[shape.orientation]
+        self._place_cells(geometry, shape.row_position, shape.column_position + geometry.min_column)
+        colors = self.colors
+        for block in shape.blocks:
+            shift = block.column_position * COLOR_BITS
+            colors[block.row_position] = (colors[block.row_position] & ~(COLOR_MASK << shift)) | (block.color << shift)
+
+    def _place_cells(self, geometry, row, column):
+        """Sets the cells of a piece (column is that of its leftmost cell) and updates the statistics."""
+        rows = self.rows
+        row_fill = self.row_fill
+        for row_offset, mask in geometry.row_masks:
+            rows[row + row_offset] |= mask << column
+            row_fill[row + row_offset] += popcount(mask)
+            if row_fill[row + row_offset] == self.num_columns:
+                self.full_rows += 1
+        heights = self.heights
+        for i in range(geometry.width):
+            c = column + i
+            lowest = row + geometry.bottom[i]
+            column_top = self.num_rows - heights[c] # row of the highest block, num_rows when empty
+            if lowest < column_top:
+                # the piece lies on top of the column, the cells of a tetromino in a column are
+                # contiguous, so at most one new hole appears: right below the piece
+                heights[c] = self.num_rows - (row + geometry.top[i])
+                if lowest + 1 < column_top:
+                    self.column_holes[c] += 1
+                    self.hole_row_sum[c] += lowest + 1
+            else: # tucked in below the top of the column
+                self._recompute_column(c)
+
+    def _recompute_column(self, c):
+        height = holes = hole_row_sum = 0
+        above = 0
+        for r, mask in enumerate(self.rows):
+            cell = mask >> c & 1
+            if cell and not height:
+                height = self.num_rows - r
+            elif above and not cell:
+                holes += 1
+                hole_row_sum += r
+            above = cell
+        self.heights[c] = height
+        self.column_holes[c] = holes
+        self.hole_row_sum[c] = hole_row_sum
+
+    def _recompute_columns(self):
+        heights = [0] * self.num_columns
+        column_holes = [0] * self.num_columns
+        hole_row_sum = [0] * self.num_columns
+        rows = self.rows
+        seen = 0
+        for r, mask in enumerate(rows):
+            tops = mask & ~seen # columns whose highest block is in this row
+            while tops:
+                lowest = tops & -tops
+                heights[lowest.bit_length() - 1] = self.num_rows - r
+                tops ^= lowest
+            holes = rows[r-1] & ~mask if r > 0 else 0
+            while holes:
+                lowest = holes & -holes
+                column_holes[lowest.bit_length() - 1] += 1
+                hole_row_sum[lowest.bit_length() - 1] += r
+                holes ^= lowest
+            seen |= mask
+        self.heights = heights
+        self.column_holes = column_holes
+        self.hole_row_sum = hole_row_sum
+
+    def _recompute_statistics(self):
+        """Rebuilds all maintained statistics from the row masks."""
+        self.row_fill = [popcount(mask) for mask in self.rows]
+        self.full_rows = self.rows.count(self.full_row)
+        self._recompute_columns()
 
     def move_shape_left(self):
         """When the user hits the left arrow."""
@@ -198,26 +335,85 @@ class Board(object):
     def drop_shape(self):
         """When you hit the enter arrow and the piece goes all the way down."""
         if self.falling_shape:
-            while not self.shape_cannot_be_placed(self.falling_shape):
-                self.falling_shape.lower_shape_by_one_row()
-            self.falling_shape.raise_shape_by_one_row()
+            self.lower_to_landing(self.falling_shape)
             if self.shape_cannot_be_placed(self.falling_shape):
                 self.end_game()
             else:
                 self.settle_falilng_shape()
             return True
 
+    def lower_to_landing(self, shape):
+        """Lowers shape to the row where it comes to rest. This is the same as lowering it
+        one row at a time until it collides and then raising it by one row, so the
+        result is one row above the start when the start itself collides."""
+        geometry = shape.orientations[shape.orientation]
+        column = shape.column_position + geometry.min_column
+        if column >= 0 and column + geometry.width <= self.num_columns and shape.row_position + geometry.min_row >= 0:
+            # highest row at which every column of the piece is above the top of that board column
+            landing = self.num_rows
+            heights = self.heights
+            bottom = geometry.bottom
+            for i in range(geometry.width):
+                row = self.num_rows - 1 - heights[column + i] - bottom[i]
+                if row < landing:
+                    landing = row
+            if landing >= shape.row_position:
+                shape.move_to(shape.column_position, landing)
+                return
+        # the piece starts below the top of one of its columns (it may be under an overhang)
+        while not self.shape_cannot_be_placed(shape):
+            shape.lower_shape_by_one_row()
+        shape.raise_shape_by_one_row()
+
     def shape_cannot_be_placed(self, shape):
-        for block in shape.blocks:
-            if (block.column_position < 0 or
-                    block.column_position >= NUM_COLUMNS or
-                    block.row_position < 0 or
-                    block.row_position >= NUM_ROWS or
-                    self.array[block.row_position][block.column_position] is not None):
+        geometry = shape.orientations[shape.orientation]
+        column = shape.column_position + geometry.min_column
+        row = shape.row_position
+        if (column < 0 or
+                column + geometry.width > self.num_columns or
+                row + geometry.min_row < 0 or
+                row + geometry.height > self.num_rows):
+            return True
+        rows = self.rows
+        for row_offset, mask in geometry.row_masks:
+            if rows[row + row_offset] & (mask << column):
                 return True
         return False
 
 
+class LineClear(object):
+    """What happened in a single line clear, see Board.remove_completed_lines."""
+    __slots__ = ('rows', 'points')
+
+    def __init__(self, rows, points):
+        self.rows = rows # indices of the removed rows, before the rows above were dropped
+        self.points = points
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class Placement(object):
+    """A trial placement on a Board, see Board.apply_placement."""
+    __slots__ = ('row', 'column', 'geometry', 'full_rows', 'heights', 'column_holes', 'hole_row_sum')
+
+    def __init__(self, row, column, geometry, full_rows, heights, column_holes, hole_row_sum):
+        self.row = row
+        self.column = column # column of the leftmost cell of the piece
+        self.geometry = geometry
+        # statistics of the board before the placement, for the columns of the piece
+        self.full_rows = full_rows
+        self.heights = heights
+        self.column_holes = column_holes
+        self.hole_row_sum = hole_row_sum
+
+    @property
+    def cells(self):
+        """(row, column) of every cell that was filled."""
+        offset = self.column - self.geometry.min_column
+        return [(self.row + row, offset + column) for column, row in self.geometry.cells]
+
+
 class BoardDrawer(object):
     def __init__(self):
         stdscr = curses.initscr()
@@ -254,13 +450,9 @@ class BoardDrawer(object):
     def update_settled_pieces(self, board):
         """Adds the already settled pieces to the next stdscr to be drawn."""
         # actual game board: settled pieces
-        for (r_index, row) in enumerate(board.array):
-            for (c_index, value) in enumerate(row):
-                block = value
-                if block:
-                    color_pair = block.color
-                else:
-                    color_pair = 0
+        for r_index in range(board.num_rows):
+            for c_index in range(board.num_columns):
+                color_pair = board.color_at(r_index, c_index)
                 self.stdscr.addstr(
                     r_index+BORDER_WIDTH,
                     c_index*BLOCK_WIDTH+BORDER_WIDTH,
@@ -273,9 +465,7 @@ class BoardDrawer(object):
         # where this piece will land
         shadow = copy.deepcopy(board.falling_shape) # deepcopy is no problem here, because only used for graphics
         if shadow:
-            while not board.shape_cannot_be_placed(shadow):
-                shadow.lower_shape_by_one_row()
-            shadow.raise_shape_by_one_row()
+            board.lower_to_landing(shadow)
             for block in shadow.blocks:
                 self.stdscr.addstr(
                     block.row_position+BORDER_WIDTH,
@@ -6,14 +6,22 @@ import sys
 import numpy as np
 import math
 import random
-import concurrent.futures
 import matplotlib.pyplot as plt
-from game import Game
 import time
+import concurrent.futures
+import os
+import zlib
 
-from players import AI
+from broker import Broker
+from checkpoint import save_run, restore_run, rng_state, set_rng_state
+from profiling import log_profile
+from telemetry import write_record, telemetry_path
+from replay import replay_path
+from evaluation import EvaluationPool, FitnessCache, game_task, is_final, successive_halving, adaptive_fitness
 
 PIECELIMIT = -1 # Maximum number of pieces in a game before game over. Set to -1 for unlimited
+DEPTH = 1 # Search depth of the AI, 2 also searches the placements of the next (preview) piece; much slower games
+BEAM_WIDTH = 4 # Placements of the current piece that are searched further with DEPTH 2
 
 ########################
 # HYPER PARAMETERS
@@ -25,6 +33,25 @@ P_GENERATIONS = 32
 P_MUTATIONREDUCTION = True
 P_BESTAMOUNT = 5
 P_GOODAMOUNT = 25
+WORKERS = None # Number of worker processes playing games, None for one per CPU
+AFFINITY = None # Optional list of CPU ids to pin the workers to
+LOCKSTEP = False # Every worker plays its share of a generation in lock-step (see population_simulator), greedy games without replays only; with QUORUM in four smaller chunks, so the quorum does not wait for whole workers
+PROFILE = False # Count the calls and time of the AI hot path in the workers, a report per generation goes to profiles/ (remote workers: python broker.py HOST PORT --profile)
+BROKER = None # (host, port) to serve the games to remote workers (python broker.py HOST PORT) instead of local processes, needs $TETRIS_BROKER_AUTHKEY
+SEED_INTERVAL = 10 # Generations between new piece sequences that all candidates play (0 for one per run, None for a random sequence per game);
+                   # the fitness cache is keyed by the seed, so it only saves the replays of elites and parents within an interval
+RUNGS = None # Piece limits of successive halving (e.g. [200, 1000, -1]), the last one replaces PIECELIMIT. None plays every game with PIECELIMIT
+KEEP = 0.5 # Fraction of the candidates promoted to the next rung
+MAX_GAMES = 1 # Most games averaged per candidate. Above 1 a candidate plays until its ranking is clear (at least MIN_GAMES games)
+MIN_GAMES = 3
+STEADY_STATE = False # Asynchronous steady-state evolution: a child is bred as soon as a worker is free, there are no generations. Single games of PIECELIMIT only (no RUNGS, MAX_GAMES 1, no REPLAYS or QUORUM)
+REPLAYS = False # Record a replay (see replay.py) of every game in replays/, only those of the elites of every generation are kept. Single games only (no RUNGS, MAX_GAMES 1, no STEADY_STATE)
+CHECKPOINT = True # Save the state of a run after every generation, a restarted run continues from it and finished runs are skipped
+TIME_LIMIT = None # Optional wall-clock budget per game in seconds, a game that hits it scores what it had so far
+QUORUM = None # Optional fraction of a generation; once that many games are finished the running games are stopped with their partial score, the others get the median game time
+CACHE_SIZE = 10000 # Number of fitnesses kept in memory, so unchanged individuals are not replayed
+CACHE_PATH = None # Optional file name of an on-disk fitness archive, shared by all runs and experiments
+SEARCH = (DEPTH, BEAM_WIDTH) if DEPTH > 1 else None # Kept with the cached fitnesses, the same weights score differently with another search
 LOG = True #When set to True it will create a log file per run with results
 EXP_NAME = 'test Optimized'
 
@@ -48,7 +75,11 @@ Steps (you can see them back in the code below):
 class SimpleEA:
 
     # constructor
-    def __init__(self, weights, popsize = 100, poffspring = 0.5, pmut = 0.1, termgeneration = 10, reduceMutationRate = True, numberOfBest = 5, numberOfGood = 25, log = False, experiment_name = " ", run = 0):
+    def __init__(self, weights, popsize = 100, poffspring = 0.5, pmut = 0.1, termgeneration = 10, reduceMutationRate = True, numberOfBest = 5, numberOfGood = 25, log = False, experiment_name = " ", run = 0, pool = None, cache = None, rungs = RUNGS, keep = KEEP, steadyState = STEADY_STATE, checkpoint = CHECKPOINT):
+        if steadyState and (rungs or MAX_GAMES > 1 or REPLAYS or QUORUM is not None):
+            # every child plays a single game of PIECELIMIT pieces as soon as a worker is free, there is
+            # no batch to halve, average or cancel; the initial population would be scored differently
+            raise ValueError("STEADY_STATE cannot be combined with RUNGS, MAX_GAMES > 1, REPLAYS or QUORUM")
         self.weights = weights # list of weights, represented by a list containing weight values
         self.popsize = popsize # population size
         self.poffspring = poffspring # offspring probability
@@ -60,8 +91,26 @@ class SimpleEA:
         self.log = log #When set to True it will create a log file per run with results
         self.experiment_name = experiment_name #name for logging purposes
         self.run = run # run number for logging purposes
+        self.pool = pool or EvaluationPool(WORKERS, AFFINITY, PROFILE, LOCKSTEP) # worker processes, shared by all runs of an experiment
+        self.ownPool = pool is None # a pool created here is closed by close, one passed in belongs to the caller
+        self.cache = cache or FitnessCache(CACHE_SIZE, CACHE_PATH, SEARCH) # fitness of already evaluated weights
+        self.ownCache = cache is None # like ownPool
+        self.seed = None # seed of the piece sequence of the current generation
+        self.traces = {} # cache key -> replay of the games of the current generation, with REPLAYS
+        self.rungs = rungs # piece limits of successive halving, None for single games of PIECELIMIT pieces
+        self.keep = keep # fraction of the candidates promoted to the next rung
+        self.steadyState = steadyState # asynchronous steady-state evolution instead of generations
+        self.checkpoint = checkpoint # save the state after every generation, and continue from a saved state
         self.bestScoreList = []
         self.bestWeightsList = []
+        self.generation = 0 # generations done
+        self.evaluations = popsize # evaluations done, for the steady-state mode
+        self.running = [] # (child, seed) of games that were still running at the checkpoint, steady-state mode only
+        self.alreadyDone = False # True when the run was already finished before a restart
+        self.recordTime = time.time() # end of the last logged generation, for the wall time of the next
+        self.cacheCounts = (self.cache.hits, self.cache.misses) # at the last logged generation
+        if self.checkpoint and self.restore():
+            return
 
         # initialize population using weights and popsize
         # population is represented by list of weights
@@ -75,41 +124,149 @@ class SimpleEA:
             self.population.append(self.normalize(tempweights))
         
         print("Running generation: 0");
+        self.updateSeed(0)
         #Step 2) evaluate quality candidate
-        self.fitnesses = []
-        processList = []
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            for i in range(self.popsize):
-                processList.append(executor.submit(self.calculateFitness, self.population[i]))
-                
-            for t in processList:
-                self.fitnesses.append(t.result())
+        self.fitnesses = self.evaluateAll(self.population)
 
         # add best result of initial population and the corresponding set of weights
         self.bestScoreList.append(max(self.fitnesses))
         self.bestWeightsList.append(self.population[self.fitnesses.index(max(self.fitnesses))])
 
         self.printGeneration(0)
-
-    # Get score from weights
-    def runTetris(self, weights = None):
-        player = AI(weights)
-        game = Game(player)
-        game.new_game(pieceLimit = PIECELIMIT)
-        return game.run_game()
-
-    # calculate fitness of a specific instance of the population
-    def calculateFitness(self, weights):
-        #TODO 2, algorithm is going to play tetris and returns its score
-        #fitness = sum(weights) #temp
-        fitness = self.runTetris(tuple(weights))
-        #print("weights", weights, "gave a score of:", fitness)
-        return fitness
+        self.logProfile(0)
+        self.keepEliteReplays()
+        if self.log == True:
+            self.logTelemetry(0) # no text line, the text log starts at generation 1
+        self.saveCheckpoint()
+
+    # closes what this instance created itself, see ownPool and ownCache
+    def close(self):
+        if self.ownPool:
+            self.pool.close()
+        if self.ownCache:
+            self.cache.close()
+
+    def checkpointName(self):
+        return 'OEA_' + str(self.experiment_name)
+
+    # text log first, then the telemetry
+    def logPaths(self):
+        return 'OEA_results/' + str(self.experiment_name), telemetry_path(self.checkpointName())
+
+    # everything needed to continue the run exactly as if it had never stopped
+    def saveCheckpoint(self):
+        if not self.checkpoint:
+            return
+        save_run(self.checkpointName(), {
+            'population': self.population, 'fitnesses': self.fitnesses,
+            'bestScoreList': self.bestScoreList, 'bestWeightsList': self.bestWeightsList,
+            'generation': self.generation, 'evaluations': self.evaluations, 'running': self.running,
+            'seed': self.seed, 'rng': rng_state(), 'cache': self.cache.entries},
+            self.checkpointConfig(), self.logPaths(),
+            self.generation >= self.termgeneration if not self.steadyState
+            else self.evaluations >= self.popsize * (self.termgeneration + 1))
+
+    # what the results of the run depend on, a checkpoint is only continued with the same
+    def checkpointConfig(self):
+        return {
+            'popsize': self.popsize, 'poffspring': self.poffspring, 'pmut': self.pmut, 'termgeneration': self.termgeneration,
+            'reduceMutationRate': self.reduceMutationRate, 'numberOfBest': self.numberOfBest,
+            'numberOfGood': self.numberOfGood, 'rungs': self.rungs, 'keep': self.keep, 'steadyState': self.steadyState,
+            'pieceLimit': PIECELIMIT, 'seedInterval': SEED_INTERVAL, 'maxGames': MAX_GAMES, 'minGames': MIN_GAMES,
+            'timeLimit': TIME_LIMIT, 'quorum': QUORUM, 'depth': DEPTH, 'beamWidth': BEAM_WIDTH}
+
+    # continue from the checkpoint of this run (see restore_run), returns False when there is none
+    # (True without a checkpoint when the log of the run is already complete)
+    def restore(self):
+        state = restore_run(self.checkpointName(), self.checkpointConfig(), self.logPaths(),
+                            self.termgeneration if self.log else None)
+        if state is None:
+            return False
+        self.alreadyDone = state['done']
+        if state.get('logComplete'):
+            print("Skipping", self.experiment_name, "(its log is complete)")
+            return True
+        self.population = state['population']
+        self.fitnesses = state['fitnesses']
+        self.bestScoreList = state['bestScoreList']
+        self.bestWeightsList = state['bestWeightsList']
+        self.generation = state['generation']
+        self.evaluations = state['evaluations']
+        self.running = state['running']
+        self.seed = state['seed']
+        set_rng_state(state['rng'])
+        for key, entry in state['cache'].items():
+            self.cache.entries[key] = entry
+        print("Resuming", self.experiment_name, "after generation", self.generation, "(done)" if self.alreadyDone else "")
+        return True
+
+    # all candidates of a generation play the same pieces (common random numbers), so their
+    # scores differ because of the weights and not because of the luck of the draw
+    def updateSeed(self, generation):
+        if SEED_INTERVAL is None:
+            self.seed = None
+        elif generation == 0 or (SEED_INTERVAL > 0 and generation % SEED_INTERVAL == 0):
+            self.seed = random.randrange(2**32)
+
+    # fitness of every instance, only instances that are not in the cache are played
+    # (elites and parents copied without crossover usually are)
+    def evaluateAll(self, instances):
+        pieceLimit = self.rungs[-1] if self.rungs else PIECELIMIT
+        fitnesses = [self.cache.get(w, self.seed, pieceLimit) for w in instances]
+        unique = {} # duplicates are played once
+        for i in range(len(instances)):
+            if fitnesses[i] is None:
+                unique.setdefault(self.cache.key(instances[i], self.seed, pieceLimit), instances[i])
+        keys = list(unique)
+        gamesPlayed = [1] * len(keys)
+        if self.rungs:
+            # successive halving: the obviously bad candidates only play short games
+            results = successive_halving(self.pool, [unique[k] for k in keys], self.rungs, self.keep, self.seed,
+                                         TIME_LIMIT, QUORUM, DEPTH, BEAM_WIDTH)
+        elif MAX_GAMES > 1:
+            # more games only for candidates that might be on either side of the last elite
+            known = [f for f in fitnesses if f is not None]
+            cutoff = lambda means: sorted(known + means, reverse=True)[min(self.numberOfBest, len(known) + len(means)) - 1]
+            estimates = adaptive_fitness(self.pool, [unique[k] for k in keys], cutoff, MIN_GAMES, MAX_GAMES,
+                                         seed=self.seed, pieceLimit=pieceLimit, timeLimit=TIME_LIMIT, quorum=QUORUM,
+                                         depth=DEPTH, beamWidth=BEAM_WIDTH)
+            results = [(mean, final) for mean, stderr, games, final in estimates]
+            gamesPlayed = [games for mean, stderr, games, final in estimates]
+        else:
+            # only the weights, piece limit and seed go to the workers, not this SimpleEA instance
+            self.traces = dict((k, self.tracePath(k)) for k in keys) if REPLAYS else {}
+            games = self.pool.play([game_task(unique[k], pieceLimit, self.seed, TIME_LIMIT, self.traces.get(k), DEPTH, BEAM_WIDTH)
+                                    for k in keys], quorum = QUORUM)
+            # partial scores of games stopped by the time limit or the quorum are not cached
+            results = [(game[0], is_final(game, pieceLimit)) for game in games]
+        scores = {}
+        for k in range(len(keys)):
+            score, final = results[k]
+            scores[keys[k]] = score
+            if final: # scores of candidates dropped at a lower rung are not the fitness of a full game
+                self.cache.put(unique[keys[k]], self.seed, pieceLimit, score, gamesPlayed[k])
+        for i in range(len(instances)):
+            if fitnesses[i] is None:
+                fitnesses[i] = scores[self.cache.key(instances[i], self.seed, pieceLimit)]
+        return fitnesses
+
+    # replays are named after the cache key, so an elite that was not played again keeps its replay
+    def tracePath(self, key):
+        return replay_path(self.checkpointName(), '%08x' % zlib.crc32(repr(key).encode()))
+
+    # deletes the replays of the games of this generation, except those of the elites
+    def keepEliteReplays(self):
+        pieceLimit = self.rungs[-1] if self.rungs else PIECELIMIT
+        ranking = sorted(range(self.popsize), key=lambda i: self.fitnesses[i], reverse=True)
+        elites = set(self.cache.key(self.population[i], self.seed, pieceLimit) for i in ranking[:self.numberOfBest])
+        for key, path in self.traces.items():
+            if key not in elites and os.path.exists(path):
+                os.remove(path)
+        self.traces = {}
 
     # evaluates quality of each candidate by updating the fitnesses list
     def evaluatePopulation(self):
-        for i in range(self.popsize):
-            self.fitnesses[i] = self.calculateFitness(i)
+        self.fitnesses = self.evaluateAll(self.population)
 
     # binary tournament selection
     # returns a single candidate (index)
@@ -173,6 +330,10 @@ class SimpleEA:
             averageweights[i] = averageweights[i]/len(self.population)
         return averageweights
 
+    # hot path profile of the games played since the last report, only when the pool profiles
+    def logProfile(self, generation):
+        log_profile('OEA_' + str(self.experiment_name), 'generation ' + str(generation), self.pool.take_profile())
+
     def printGeneration(self, generation):
         # Print generation results
         print("Best score for generation", generation, ":", max(self.fitnesses))
@@ -181,13 +342,36 @@ class SimpleEA:
         print("Average weights for generation", generation, ":",  [ '%.3f' % w for w in self.averageWeights() ])
         print("-------------------------")
 
+    # structured record of a generation (see telemetry), the text log line is written from it
+    def logTelemetry(self, generation):
+        best = self.fitnesses.index(max(self.fitnesses))
+        now = time.time()
+        record = {
+            'generation': generation,
+            'time': now,
+            'wallSeconds': now - self.recordTime,
+            'best': self.fitnesses[best],
+            'bestWeights': [float(w) for w in self.population[best]],
+            'average': sum(self.fitnesses)/len(self.fitnesses),
+            'averageWeights': [float(w) for w in self.averageWeights()],
+            'seed': self.seed,
+            'cacheHits': self.cache.hits - self.cacheCounts[0],
+            'cacheMisses': self.cache.misses - self.cacheCounts[1],
+            'evaluation': self.pool.take_telemetry(),
+        }
+        self.recordTime = now
+        self.cacheCounts = (self.cache.hits, self.cache.misses)
+        write_record(self.checkpointName(), record)
+        return record
+
     def log_results(self, generation):
+        record = self.logTelemetry(generation)
         with open('OEA_results/'+ str(self.experiment_name), 'a') as file:
-            toLog = (str(generation) + '|' 
-                + ", ".join(['%.4f' % x for x in self.population[self.fitnesses.index(max(self.fitnesses))]]) 
-                + '|' + str(max(self.fitnesses))
-                + '|' + ", ".join(['%.4f' % x for x in self.averageWeights()]) 
-                + '|' + str((sum(self.fitnesses)/len(self.fitnesses))))
+            toLog = (str(record['generation']) + '|' 
+                + ", ".join(['%.4f' % x for x in record['bestWeights']]) 
+                + '|' + str(record['best'])
+                + '|' + ", ".join(['%.4f' % x for x in record['averageWeights']]) 
+                + '|' + str(record['average']))
             file.write(toLog + '\n')
         
     def eliteSelection(self, best, good):
@@ -202,10 +386,84 @@ class SimpleEA:
 
         return returnList
 
+    # one child of two tournament winners, with crossover and mutation
+    # progress (0 to 1) reduces the mutation rate like the generations do in runEA
+    def breed(self, progress):
+        parent1 = self.binaryTournamentSelect()
+        parent2 = self.binaryTournamentSelect()
+        if random.random() < self.poffspring:
+            child = self.generateOffspring(parent1, parent2)[0]
+        else:
+            child = list(self.population[parent1]) # a copy, mutation changes it in place
+        pmut = self.pmut * (1 - progress) if self.reduceMutationRate else self.pmut
+        if random.random() < pmut:
+            child = self.doMutation(child)
+        return child
+
+    # steady-state replacement: the child replaces the loser of a reverse binary tournament,
+    # the numberOfBest best instances are never replaced
+    def insert(self, instance, fitness):
+        ranking = sorted(range(self.popsize), key=lambda i: self.fitnesses[i], reverse=True)
+        candidates = ranking[self.numberOfBest:] or ranking
+        candidate1 = random.choice(candidates)
+        candidate2 = random.choice(candidates)
+        loser = candidate1 if self.fitnesses[candidate1] < self.fitnesses[candidate2] else candidate2
+        self.population[loser] = instance
+        self.fitnesses[loser] = fitness
+
+    # STEP 3 without a generation barrier: as soon as a game finishes its candidate is inserted
+    # and a new child is submitted, so no worker waits for the slowest game of a generation.
+    # Runs as many evaluations as termgeneration generations would, results are printed and
+    # logged every popsize evaluations with the number of evaluations in place of the generation
+    def runSteadyState(self):
+        evaluations = self.evaluations
+        total = self.popsize * (self.termgeneration + 1)
+        running = {} # future -> (child, seed)
+        for child, seed in self.running: # games that were running when the checkpoint was saved
+            running[self.pool.submit_game(game_task(child, PIECELIMIT, seed, TIME_LIMIT, None, DEPTH, BEAM_WIDTH))] = (child, seed)
+
+        def add(child, fitness):
+            nonlocal evaluations
+            self.insert(child, fitness)
+            evaluations += 1
+            if evaluations % self.popsize == 0:
+                self.updateSeed(evaluations // self.popsize)
+                self.bestScoreList.append(max(self.fitnesses))
+                self.bestWeightsList.append(self.population[self.fitnesses.index(max(self.fitnesses))])
+                print("Evaluations:", evaluations)
+                self.printGeneration(evaluations // self.popsize - 1)
+                self.logProfile(evaluations // self.popsize - 1)
+                if self.log == True:
+                    self.log_results(evaluations)
+                self.evaluations = evaluations
+                self.generation = evaluations // self.popsize - 1
+                self.running = list(running.values())
+                self.saveCheckpoint()
+
+        while evaluations < total or running:
+            while evaluations + len(running) < total and len(running) < self.pool.workers:
+                child = self.breed(evaluations / total)
+                fitness = self.cache.get(child, self.seed, PIECELIMIT)
+                if fitness is not None:
+                    add(child, fitness)
+                else:
+                    running[self.pool.submit_game(game_task(child, PIECELIMIT, self.seed, TIME_LIMIT, None, DEPTH, BEAM_WIDTH))] = (child, self.seed)
+            done, notDone = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                child, seed = running.pop(future)
+                game = future.result()
+                if is_final(game, PIECELIMIT):
+                    self.cache.put(child, seed, PIECELIMIT, game[0])
+                add(child, game[0])
+
+        return self.bestScoreList
+
     # TODO
     # STEP 3: run algorithm until termination condition satisfied
     def runEA(self):
-        generation = 0
+        if self.steadyState:
+            return self.runSteadyState()
+        generation = self.generation
         while generation < self.termgeneration:
 
             # list containing the next generation, prefilled with winners of binary tournament
@@ -249,15 +507,10 @@ class SimpleEA:
 
             generation += 1
             print("Running generation:", generation);
+            self.updateSeed(generation)
                 
             # d: Evaluate the new candidates
-            nextGenerationFitnesses = []
-            processList = []
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                for c in range(self.popsize):
-                    processList.append(executor.submit(self.calculateFitness, nextGeneration[c]))
-                for t in processList:
-                    nextGenerationFitnesses.append(t.result())
+            nextGenerationFitnesses = self.evaluateAll(nextGeneration)
 
             # average fitness decrease. Not used, but can be interesting
             """
@@ -275,29 +528,43 @@ class SimpleEA:
             self.bestWeightsList.append(self.population[self.fitnesses.index(max(self.fitnesses))])
 
             self.printGeneration(generation)
+            self.logProfile(generation)
+            self.keepEliteReplays()
 
             if self.log == True:
                 self.log_results(generation)
+            self.generation = generation
+            self.saveCheckpoint()
             # done with iteration
 
         # when done, return the list of best scores for each iteration
         return self.bestScoreList
 
 runs = 10 #Number of runs
-for run in range(runs):
-    start = time.time()
-    experiment = str(run) + '_' + "Base"
-    bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, P_MUTATIONREDUCTION, P_BESTAMOUNT, P_GOODAMOUNT, LOG, experiment, run)
-    bleh.runEA()
-    end = time.time()
-    with open('OEA_results/'+ "Base" + "_times", 'a') as file:
-        file.write("Running time: " + str(end-start) + " seconds" + '\n')
+pool = Broker(BROKER, workers=WORKERS) if BROKER else EvaluationPool(WORKERS, AFFINITY, PROFILE, LOCKSTEP) # created once, used by all runs
+cache = FitnessCache(CACHE_SIZE, CACHE_PATH, SEARCH)
+try:
+    for run in range(runs):
+        start = time.time()
+        experiment = str(run) + '_' + "Base"
+        bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, P_MUTATIONREDUCTION, P_BESTAMOUNT, P_GOODAMOUNT, LOG, experiment, run, pool, cache)
+        if bleh.alreadyDone: # finished before a restart, its results are already logged
+            continue
+        bleh.runEA()
+        end = time.time()
+        with open('OEA_results/'+ "Base" + "_times", 'a') as file:
+            file.write("Running time: " + str(end-start) + " seconds" + '\n')
+finally: # the worker processes (or the listener of the broker) and the archive of the cache are not left to the interpreter
+    pool.close()
+    cache.close()
     
 """    
 for run in range(runs):
     start = time.time()
     experiment = str(run) + '_' + "Final"
-    bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, 0.4, 0.4, P_GENERATIONS, P_MUTATIONREDUCTION, 10, 10, LOG, experiment, run)
+    bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, 0.4, 0.4, P_GENERATIONS, P_MUTATIONREDUCTION, 10, 10, LOG, experiment, run, pool, cache)
+    if bleh.alreadyDone: # finished before a restart, its results are already logged
+        continue
     bleh.runEA()
     end = time.time()
     with open('OEA_results/'+ "Final" + "_times", 'a') as file:
@@ -307,7 +574,9 @@ for mut in range(5):
     for run in range(runs):
         start = time.time()
         experiment = str(run) + '_' + "OptimizedMutation_" + str(mut+1)
-        bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, (mut+1)*0.1, P_GENERATIONS, P_MUTATIONREDUCTION, P_BESTAMOUNT, P_GOODAMOUNT, LOG, experiment, run)
+        bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, (mut+1)*0.1, P_GENERATIONS, P_MUTATIONREDUCTION, P_BESTAMOUNT, P_GOODAMOUNT, LOG, experiment, run, pool, cache)
+        if bleh.alreadyDone: # finished before a restart, its results are already logged
+            continue
         bleh.runEA()
         end = time.time()
         with open('OEA_results/'+ "OptimizedMutation_" + str(mut+1) + "_times", 'a') as file:
@@ -316,7 +585,9 @@ for mut in range(5):
 for run in range(runs):
     start = time.time()
     experiment = str(run) + '_' + "LinMut"
-    bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, False, P_BESTAMOUNT, P_GOODAMOUNT, LOG, experiment, run)
+    bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, False, P_BESTAMOUNT, P_GOODAMOUNT, LOG, experiment, run, pool, cache)
+    if bleh.alreadyDone: # finished before a restart, its results are already logged
+        continue
     bleh.runEA()
     end = time.time()
     with open('OEA_results/'+ "LinMut" + "_times", 'a') as file:
@@ -325,7 +596,9 @@ for run in range(runs):
 for run in range(runs):
     start = time.time()
     experiment = str(run) + '_' + "KeepBestHalf"
-    bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, P_MUTATIONREDUCTION, 50, 50, LOG, experiment, run)
+    bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, P_MUTATIONREDUCTION, 50, 50, LOG, experiment, run, pool, cache)
+    if bleh.alreadyDone: # finished before a restart, its results are already logged
+        continue
     bleh.runEA()
     end = time.time()
     with open('OEA_results/'+ "KeepBestHalf" + "_times", 'a') as file:
@@ -335,7 +608,9 @@ for es in range(3):
     for run in range(runs):
         start = time.time()
         experiment = str(run) + '_' + "EliteSelection_" + str(es+1)
-        bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, P_MUTATIONREDUCTION, (es+1)*10, (es+1)*20, LOG, experiment, run)
+        bleh = SimpleEA([None] * 8, P_POPULATIONSIZE, P_CROSSOVER, P_MUTATION, P_GENERATIONS, P_MUTATIONREDUCTION, (es+1)*10, (es+1)*20, LOG, experiment, run, pool, cache)
+        if bleh.alreadyDone: # finished before a restart, its results are already logged
+            continue
         bleh.runEA()
         end = time.time()
         with open('OEA_results/'+ "EliteSelection_" + str(es+1) + "_times", 'a') as file:
@@ -1,10 +1,12 @@
 """Tetris Pieces and mechanisms for manipulating them."""
 
+import random
 from random import randint
 
 
 class Block(object):
     """Represents one block in a tetris piece."""
+    __slots__ = ('row_position', 'column_position', 'color')
 
     def __init__(self, row_position, column_position, color):
         self.row_position = row_position
@@ -15,9 +17,53 @@ class Block(object):
         return Block(self.row_position, self.column_position, self.color)
 
 
+class Orientation(object):
+    """Precomputed geometry of a single orientation of a tetromino.
+
+    One instance exists per tetromino and orientation (see PIECE_TABLE) and it
+    is shared by every Shape of that kind, so nothing here may be mutated.
+    """
+    __slots__ = ('cells', 'min_column', 'max_column', 'min_row', 'width', 'height',
+                 'top', 'bottom', 'bottom_indices', 'row_masks')
+
+    def __init__(self, cells):
+        self.cells = tuple(cells) # (column, row) offsets from the base position
+        columns = [cell[0] for cell in self.cells]
+        rows = [cell[1] for cell in self.cells]
+        self.min_column = min(columns)
+        self.max_column = max(columns)
+        self.min_row = min(rows)
+        self.width = self.max_column - self.min_column + 1
+        self.height = max(rows) + 1 # in rows below the base position
+        # highest and lowest row offset of each column, from the leftmost column of the piece
+        self.top = tuple(min(row for column, row in self.cells if column == self.min_column + i)
+                         for i in range(self.width))
+        self.bottom = tuple(max(row for column, row in self.cells if column == self.min_column + i)
+                            for i in range(self.width))
+        # indices of the blocks that have no other block of the piece below them
+        self.bottom_indices = tuple(index for index, (column, row) in enumerate(self.cells)
+                                    if row == self.bottom[column - self.min_column])
+        # bitmask of every occupied row, with bit 0 being the leftmost column of the piece
+        masks = {}
+        for column, row in self.cells:
+            masks[row] = masks.get(row, 0) | 1 << (column - self.min_column)
+        self.row_masks = tuple(sorted(masks.items()))
+
+    def legal_columns(self, num_columns):
+        """Base columns at which this orientation fits between the walls."""
+        return range(-self.min_column, num_columns - self.max_column)
+
+
 class Shape(object):
     """The object representing a shape, including its position, orientation,
     color, and set of blocks it includes."""
+    __slots__ = ('column_position', 'row_position', 'color', 'orientation', 'blocks')
+
+    number_of_orientations = None # set by every tetromino
+    block_positions = None # set by every tetromino
+    orientations = None # shared Orientation objects, filled in from PIECE_TABLE
+    default_color = None # colour and orientation of a newly drawn tetromino
+    default_orientation = 0
 
     def __init__(self, column, row, color=None, orientation=None):
         self.column_position = column
@@ -47,46 +93,41 @@ class Shape(object):
         self._rotate_blocks(self.orientation)
 
     @property
-    def number_of_orientations(self):
-        raise NotImplementedError
-
-    @property
-    def block_positions(self):
-        """A dict of lists of the positions for each block in the Shape, for each orientation.
-
-        Note: These are *relative* positions as compared to the base position of the current Shape.
-        """
-        raise NotImplementedError
+    def geometry(self):
+        """The shared Orientation for the current orientation."""
+        return self.orientations[self.orientation]
+
+    @classmethod
+    def placements(cls, num_columns):
+        """All (column, orientation) pairs that fit on a board of the given width,
+        ordered by column and then by orientation."""
+        key = (cls, num_columns)
+        if key not in _PLACEMENTS:
+            _PLACEMENTS[key] = tuple(sorted((column, orientation)
+                                            for orientation, geometry in enumerate(cls.orientations)
+                                            for column in geometry.legal_columns(num_columns)))
+        return _PLACEMENTS[key]
 
     @property
     def bottom_blocks_for_orientations(self):
         """A dit of lists of the blocks on the bottom positions of the Shape, for each orientation."""
-        bottom_blocks_for_orientation = {}
-        for orientation in self.block_positions:
-            bottom_blocks_for_orientation[orientation] = []
-            for index, position in enumerate(self.block_positions[orientation]):
-                if any([other_position[0] == position[0]
-                        and other_position[1] > position[1]
-                        for other_position in self.block_positions[orientation]]):
-                    pass
-                else:
-                    bottom_blocks_for_orientation[orientation].append(self.blocks[index])
-        return bottom_blocks_for_orientation
+        return {orientation: [self.blocks[index] for index in geometry.bottom_indices]
+                for orientation, geometry in enumerate(self.orientations)}
 
     @property
     def bottom_blocks(self):
         """The blocks currently on the bottom of the Shape."""
-        return self.bottom_blocks_for_orientations[self.orientation]
+        return [self.blocks[index] for index in self.geometry.bottom_indices]
 
     def _initialize_blocks(self):
-        relative_block_positions = self.block_positions[self.orientation]
+        relative_block_positions = self.orientations[self.orientation].cells
         self.blocks = [Block(self.row_position+diff[1],
                              self.column_position+diff[0],
                              self.color)
                        for diff in relative_block_positions]
 
     def _rotate_blocks(self, orientation):
-        new_block_positions_diff = self.block_positions[orientation]
+        new_block_positions_diff = self.orientations[orientation].cells
         for (index, diff) in enumerate(new_block_positions_diff):
             self.blocks[index].column_position = self.column_position + diff[0]
             self.blocks[index].row_position = self.row_position + diff[1]
@@ -138,15 +179,13 @@ class SquareShape(Shape):
         * is the "base" location for the Shape. The block positions
           are offsets from this location.
     """
-    @property
-    def number_of_orientations(self):
-        return 1
-
-    @property
-    def block_positions(self):
-        return {
-            0: [(0, 0), (1, 0), (0, 1), (1, 1)],
-        }
+    __slots__ = ()
+    number_of_orientations = 1
+    default_color = 6
+    default_orientation = 0
+    block_positions = {
+        0: [(0, 0), (1, 0), (0, 1), (1, 1)],
+    }
 
 
 class TShape(Shape):
@@ -156,18 +195,16 @@ class TShape(Shape):
                   | 1 | 2 | 3 |    | 2 | 0 |    | 1 | 2 | 3 |     | 0 | 2 |
                                    | 3 |            | 0 |             | 3 |
     """
-    @property
-    def number_of_orientations(self):
-        return 4
-
-    @property
-    def block_positions(self):
-        return {
-            0: [(1, 0), (0, 1), (1, 1), (2, 1)],
-            1: [(2, 1), (1, 0), (1, 1), (1, 2)],
-            2: [(1, 2), (0, 1), (1, 1), (2, 1)],
-            3: [(0, 1), (1, 0), (1, 1), (1, 2)]
-        }
+    __slots__ = ()
+    number_of_orientations = 4
+    default_color = 4
+    default_orientation = 0
+    block_positions = {
+        0: [(1, 0), (0, 1), (1, 1), (2, 1)],
+        1: [(2, 1), (1, 0), (1, 1), (1, 2)],
+        2: [(1, 2), (0, 1), (1, 1), (2, 1)],
+        3: [(0, 1), (1, 0), (1, 1), (1, 2)]
+    }
 
 
 class LineShape(Shape):
@@ -178,16 +215,14 @@ class LineShape(Shape):
                     | 2 |
                     | 3 |
     """
-    @property
-    def number_of_orientations(self):
-        return 2
-
-    @property
-    def block_positions(self):
-        return {
-            0: [(0, 0), (0, 1), (0, 2), (0, 3)],
-            1: [(-1, 0), (0, 0), (1, 0), (2, 0)],
-        }
+    __slots__ = ()
+    number_of_orientations = 2
+    default_color = 5
+    default_orientation = 1
+    block_positions = {
+        0: [(0, 0), (0, 1), (0, 2), (0, 3)],
+        1: [(-1, 0), (0, 0), (1, 0), (2, 0)],
+    }
 
 
 class SShape(Shape):
@@ -197,16 +232,14 @@ class SShape(Shape):
                     | 1 | 2 |   | 3 | 2 |
                         | 3 |
     """
-    @property
-    def number_of_orientations(self):
-        return 2
-
-    @property
-    def block_positions(self):
-        return {
-            0: [(0, 0), (0, 1), (1, 1), (1, 2)],
-            1: [(2, 0), (1, 0), (1, 1), (0, 1)],
-        }
+    __slots__ = ()
+    number_of_orientations = 2
+    default_color = 3
+    default_orientation = 1
+    block_positions = {
+        0: [(0, 0), (0, 1), (1, 1), (1, 2)],
+        1: [(2, 0), (1, 0), (1, 1), (0, 1)],
+    }
 
 
 class ZShape(Shape):
@@ -216,16 +249,14 @@ class ZShape(Shape):
                     | 2 | 1 |       | 2 | 3 |
                     | 3 |
     """
-    @property
-    def number_of_orientations(self):
-        return 2
-
-    @property
-    def block_positions(self):
-        return {
-            0: [(1, 0), (1, 1), (0, 1), (0, 2)],
-            1: [(-1, 0), (0, 0), (0, 1), (1, 1)],
-        }
+    __slots__ = ()
+    number_of_orientations = 2
+    default_color = 1
+    default_orientation = 1
+    block_positions = {
+        0: [(1, 0), (1, 1), (0, 1), (0, 2)],
+        1: [(-1, 0), (0, 0), (0, 1), (1, 1)],
+    }
 
 
 class LShape(Shape):
@@ -235,18 +266,16 @@ class LShape(Shape):
                     | 1 |       | 2 | 1 | 0 |       | 1 |   | 0 | 1 | 2 |
                     | 2 | 3 |   | 3 |               | 0 |
     """
-    @property
-    def number_of_orientations(self):
-        return 4
-
-    @property
-    def block_positions(self):
-        return {
-            0: [(0, 0), (0, 1), (0, 2), (1, 2)],
-            1: [(1, 1), (0, 1), (-1, 1), (-1, 2)],
-            2: [(0, 2), (0, 1), (0, 0), (-1, 0)],
-            3: [(-1, 1), (0, 1), (1, 1), (1, 0)]
-        }
+    __slots__ = ()
+    number_of_orientations = 4
+    default_color = 6
+    default_orientation = 3
+    block_positions = {
+        0: [(0, 0), (0, 1), (0, 2), (1, 2)],
+        1: [(1, 1), (0, 1), (-1, 1), (-1, 2)],
+        2: [(0, 2), (0, 1), (0, 0), (-1, 0)],
+        3: [(-1, 1), (0, 1), (1, 1), (1, 0)]
+    }
 
 
 class JShape(Shape):
@@ -256,15 +285,76 @@ class JShape(Shape):
                       | 1 |   | 2 | 1 | 0 |   | 1 |               | 3 |
                   | 3 | 2 |                   | 0 |
     """
-    @property
-    def number_of_orientations(self):
-        return 4
-
-    @property
-    def block_positions(self):
-        return {
-            0: [(1, 0), (1, 1), (1, 2), (0, 2)],
-            1: [(2, 1), (1, 1), (0, 1), (0, 0)],
-            2: [(0, 2), (0, 1), (0, 0), (1, 0)],
-            3: [(0, 0), (1, 0), (2, 0), (2, 1)]
-        }
+    __slots__ = ()
+    number_of_orientations = 4
+    default_color = 2
+    default_orientation = 1
+    block_positions = {
+        0: [(1, 0), (1, 1), (1, 2), (0, 2)],
+        1: [(2, 1), (1, 1), (0, 1), (0, 0)],
+        2: [(0, 2), (0, 1), (0, 0), (1, 0)],
+        3: [(0, 0), (1, 0), (2, 0), (2, 1)]
+    }
+
+
+# all tetrominos, in the order in which they are put in a fresh bag
+TETROMINOES = (SquareShape, LineShape, SShape, LShape, TShape, ZShape, JShape)
+
+# flyweight geometry table, built once at import time and shared by all shapes
+PIECE_TABLE = {}
+for _shape in TETROMINOES:
+    PIECE_TABLE[_shape] = tuple(Orientation(_shape.block_positions[orientation])
+                                for orientation in range(_shape.number_of_orientations))
+    _shape.orientations = PIECE_TABLE[_shape]
+
+_PLACEMENTS = {} # (shape class, number of columns) -> placements, see Shape.placements
+
+
+class PieceSequence(object):
+    """Seedable stream of tetromino classes with 7-bag semantics.
+
+    Every bag holds each of the TETROMINOES once, in shuffled order; a new bag
+    is shuffled when the previous one is used up. The sequence owns its random
+    source, so every game (or every candidate of a generation) can play the same
+    pieces by using the same seed. None for seed draws from the global random state.
+    """
+    __slots__ = ('random', 'bag', 'index', 'shared')
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed) if seed is not None else random
+        self.bag = list(TETROMINOES)
+        self.index = 0
+        self.shared = False # whether copies use the same random source, see copy
+        self.shuffle()
+
+    def shuffle(self):
+        if self.shared:
+            # the first shuffle after a copy forks the random source, which nobody has drawn from since
+            state = self.random.getstate()
+            self.random = random.Random()
+            self.random.setstate(state)
+            self.shared = False
+        self.random.shuffle(self.bag)
+
+    def copy(self):
+        """Copy with its own bag and position. A seeded copy draws the same pieces as the original
+        would from here on, without changing what the original draws; the random source is only
+        duplicated when one of them needs a new bag, so copies stay cheap. An unseeded copy
+        keeps drawing from the global random state."""
+        sequence = PieceSequence.__new__(PieceSequence)
+        sequence.random = self.random
+        sequence.bag = self.bag[:]
+        sequence.index = self.index
+        sequence.shared = self.shared = self.random is not random
+        return sequence
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        tetromino = self.bag[self.index]
+        self.index += 1
+        if self.index == len(self.bag):
+            self.index = 0
+            self.shuffle()
+        return tetromino
@@ -1,11 +1,18 @@
 import time
-import curses
-from game_board import NUM_COLUMNS, NUM_ROWS, BORDER_WIDTH, BLOCK_WIDTH, PREVIEW_COLUMN
+import numpy as np
+from game_board import NUM_COLUMNS, BORDER_WIDTH, BLOCK_WIDTH, PREVIEW_COLUMN
+
+try:
+    import curses
+except ImportError: # only needed to show the AI at work
+    curses = None
 
 SHOW_AI = False
 SHOW_AI_SPEED = 0.05
 AI_DISPLAY_SCREEN = False
 DEBUG_SCORE = False
+BEAM_WIDTH = 4 # first moves that are searched further with a two-piece lookahead
+TRANSPOSITION_LIMIT = 100000 # boards remembered by the lookahead before the table is emptied
 
 ##########################
 # FEATURES/SCORE FUNCTIONS
@@ -13,10 +20,7 @@ DEBUG_SCORE = False
 
 # Calculates the number of full horizontal rows
 def getFullRows(board):
-    rows = 0
-    for row in board.array:
-        if all(row):
-            rows += 1
+    rows = board.full_rows # maintained by the board
     if DEBUG_SCORE:
         print("Rows:", rows)
     return rows
@@ -24,12 +28,7 @@ def getFullRows(board):
 # Calculates the number of holes in each column (so a hole that spans over two columns count as two).
 # Holes of multiple cells deep count as a single hole
 def getHoles(board):
-    holes = 0
-    for r, row in enumerate(board.array):
-        if r > 0: # ceiling does not count!
-            for c, cell in enumerate(row):
-                if not cell and board.array[r-1][c]: # index always safe, because the top row is skipped
-                    holes += 1
+    holes = sum(board.column_holes) # empty cells with a block directly above, maintained by the board
     if DEBUG_SCORE:
         print("Holes:", holes)
     return holes
@@ -40,18 +39,9 @@ def getHoles(board):
 # Deep holes are only counted once (based on their top height, by only counting empty cells with a block above
 def getHoleDepth(board):
     cumulativeHoleDepth = 0
-    for c in range(NUM_COLUMNS): # for each column
-        foundBlock = False
-        blockHeight = 0 # used for calculating the hole depth
-        for r in range(NUM_ROWS): # for each row
-            if not foundBlock: # first we need to find the highest block
-                if board.array[r][c]:
-                    foundBlock = True
-                    blockHeight = NUM_ROWS - r
-            else: # if we found a block already, we are counting holes
-                if not board.array[r][c]: # found a hole
-                    if r > 0 and board.array[r-1][c]: # only count deep holes once, r>0 is just for safety although not needed
-                        cumulativeHoleDepth += blockHeight - (NUM_ROWS - r)
+    for c in range(board.num_columns): # for each column
+        # the depth of a hole in row r is r - (num_rows - height), summed over the holes of the column
+        cumulativeHoleDepth += board.hole_row_sum[c] - board.column_holes[c] * (board.num_rows - board.heights[c])
 
     if DEBUG_SCORE:
         print("holeDepth:", cumulativeHoleDepth)
@@ -142,12 +132,45 @@ def getDeltaHeight(heights):
 
 # Calculates the heights of the columns on the board for easier and more efficient calculations
 def getHeights(board):
-    heights = [0] * board.num_columns
-    for r in range (board.num_rows):
-        for c in range (board.num_columns):
-            if board.array[board.num_rows - 1 - r][c] is not None:
-                heights[c] = r+1
-    return heights
+    return board.heights[:] # maintained by the board
+
+# Calculates all features for a batch of boards at once, one row per board
+# The columns are in the same order as the weights of the AI, the values are the same as the functions above
+#   heights is a (boards x columns) array, counts a (boards x 3) array with the full rows, holes and hole depth
+def getFeatureMatrix(heights, counts):
+    diffs = heights[:, 1:] - heights[:, :-1]
+    wellDepths = getWellDepthMatrix(heights)
+
+    features = np.empty((len(heights), 8), dtype=np.int64)
+    features[:, 0:3] = counts
+    features[:, 3] = getBumpinessColumn(diffs)
+    features[:, 4] = getDeepWellsColumn(wellDepths)
+    features[:, 5] = getDeltaHeightColumn(heights)
+    features[:, 6] = getShallowWellsColumn(wellDepths)
+    features[:, 7] = getPatternDiversityColumn(diffs)
+    return features
+
+# The columns of getFeatureMatrix, separate so that profiling times each of them
+#   diffs is the (boards x columns-1) array of height differences of adjacent columns
+def getWellDepthMatrix(heights):
+    padded = np.pad(heights, ((0, 0), (1, 1)), constant_values=np.iinfo(heights.dtype).max) # walls never form a well
+    return np.minimum(padded[:, :-2], padded[:, 2:]) - heights
+
+def getBumpinessColumn(diffs):
+    return np.abs(diffs).sum(axis=1)
+
+def getDeepWellsColumn(wellDepths):
+    return np.where(wellDepths > 1, wellDepths, 0).sum(axis=1)
+
+def getDeltaHeightColumn(heights):
+    return heights.max(axis=1) - heights.min(axis=1)
+
+def getShallowWellsColumn(wellDepths):
+    return (wellDepths == 1).sum(axis=1)
+
+def getPatternDiversityColumn(diffs):
+    sortedDiffs = np.sort(diffs, axis=1)
+    return 1 + (sortedDiffs[:, 1:] != sortedDiffs[:, :-1]).sum(axis=1)
 
 #################
 # AI CODE
@@ -155,8 +178,16 @@ def getHeights(board):
 
 class AI(object):
 
-    def __init__(self, weights=None):
+    def __init__(self, weights=None, batched=True, depth=1, beamWidth=BEAM_WIDTH):
         self.weights = weights or (0.91085795, -1.14138722, -0.11095269, -0.21057699, 0.22961168, 0.02429384, -0.5, 0.5)
+        self.batched = batched # score all placements of a move at once with NumPy
+        if depth not in (1, 2):
+            raise ValueError("depth must be 1 or 2, only the next piece is known")
+        self.depth = depth # 2 also searches the placements of the next (preview) piece
+        self.beamWidth = beamWidth
+        self.transpositions = {} # (board rows, tetromino) -> best score of that tetromino on that board
+        self.nodes_expanded = 0 # placements scored for the last move
+        self.total_nodes_expanded = 0
 
     def score_board(self, original_board, this_board):
         heights = getHeights(this_board)
@@ -188,7 +219,37 @@ class AI(object):
             print()
         return score
 
+    def score_features(self, features):
+        """Scores of a (boards x features) matrix, the batched version of score_board.
+
+        This is the product of the matrix with the weights, but it is accumulated
+        column by column in the same order as score_board, so the rounding (and
+        with it the chosen move) is exactly the same.
+        """
+        scores = features[:, 0] * float(self.weights[0])
+        for i in range(1, len(self.weights)):
+            scores += features[:, i] * float(self.weights[i])
+        return scores
+
+    def candidate_placements(self, game_board, shape=None):
+        """Moves the shape (the falling shape by default) to the landing position of every
+        valid placement in turn and yields it there. The board itself is not copied or changed."""
+        shape = shape or game_board.falling_shape
+        # only the (column, orientation) pairs that fit between the walls, precomputed per tetromino
+        for column_position, orientation in shape.placements(NUM_COLUMNS):
+            shape.orientation = orientation
+            shape.move_to(column_position, 2)
+            game_board.lower_to_landing(shape)
+            if not game_board.shape_cannot_be_placed(shape):
+                # now we have a valid possible placement
+                yield shape
+
     def get_moves(self, game_board, board_drawer):
+        if self.depth == 2 and game_board.next_shape is not None:
+            return self.get_moves_lookahead(game_board)
+        if self.batched and not SHOW_AI and not DEBUG_SCORE:
+            return self.get_moves_batched(game_board)
+
         #start = time.time()
         max_score = -100000
 
@@ -196,52 +257,129 @@ class AI(object):
         best_final_row_position = None
         best_final_orientation = None
 
-        falling_orientations = game_board.falling_shape.number_of_orientations
         next_orientations = game_board.next_shape.number_of_orientations
 
-        originalBoard = game_board.deepBoardCopy()
-        for column_position in range(-2, NUM_COLUMNS + 2): # we add -2 and +2 here to make sure all positions at all orientations are included
-            for orientation in range(falling_orientations):
-                board = originalBoard.deepBoardCopy()
-                board.falling_shape.orientation = orientation
-                board.falling_shape.move_to(column_position, 2)
-
-                while not board.shape_cannot_be_placed(board.falling_shape):
-                    board.falling_shape.lower_shape_by_one_row()
-                board.falling_shape.raise_shape_by_one_row()
-                if not board.shape_cannot_be_placed(board.falling_shape):
-                    # now we have a valid possible placement
-                    
-                    # show placement of the AI
-                    if SHOW_AI:
-                        board_drawer.update_settled_pieces(board)  # clears out the old shadow locations
-                        board_drawer.update_falling_piece(game_board)
-                        board_drawer.update_shadow(board)
-                        board_drawer.refresh_screen()
-
-                    board._settle_shape_no_clear(board.falling_shape)
-
-                    score = self.score_board(game_board, board)
-                    if score > max_score:
-                        max_score = score
-                        best_final_column_position = board.falling_shape.column_position
-                        best_final_row_position = board.falling_shape.row_position
-                        best_final_orientation = board.falling_shape.orientation
-
-                    if SHOW_AI:
-                        board_drawer.stdscr.addstr(
-                            BORDER_WIDTH + 14,
-                            PREVIEW_COLUMN*BLOCK_WIDTH-2+BORDER_WIDTH,
-                            'PLACEMENT SCORE: %f' % score,
-                            curses.color_pair(7)
-                        )
-                        time.sleep(SHOW_AI_SPEED)
+        for shape in self.candidate_placements(game_board):
+            # show placement of the AI
+            if SHOW_AI:
+                board_drawer.update_settled_pieces(game_board)  # clears out the old shadow locations
+                board_drawer.update_falling_piece(game_board)
+                board_drawer.update_shadow(game_board)
+                board_drawer.refresh_screen()
+
+            placement = game_board.apply_placement(shape)
+            score = self.score_board(game_board, game_board)
+            game_board.undo_placement(placement)
+            if score > max_score:
+                max_score = score
+                best_final_column_position = shape.column_position
+                best_final_row_position = shape.row_position
+                best_final_orientation = shape.orientation
+
+            if SHOW_AI:
+                board_drawer.stdscr.addstr(
+                    BORDER_WIDTH + 14,
+                    PREVIEW_COLUMN*BLOCK_WIDTH-2+BORDER_WIDTH,
+                    'PLACEMENT SCORE: %f' % score,
+                    curses.color_pair(7)
+                )
+                time.sleep(SHOW_AI_SPEED)
 
         #end = time.time()
         #print("Time used to find a placement:", end-start)
 
         return best_final_row_position, best_final_column_position, best_final_orientation
 
+    def placement_scores(self, game_board, shape=None):
+        """Every valid placement of the shape (the falling shape by default) as (row, column,
+        orientation), and an array with their scores. The board is left as it was."""
+        placements = []
+        if not self.batched:
+            scores = []
+            for shape in self.candidate_placements(game_board, shape):
+                placements.append((shape.row_position, shape.column_position, shape.orientation))
+                placement = game_board.apply_placement(shape)
+                scores.append(self.score_board(game_board, game_board))
+                game_board.undo_placement(placement)
+            return placements, np.array(scores)
+
+        placements, features = self.placement_features(game_board, shape)
+        if not placements:
+            return placements, np.empty(0)
+        return placements, self.score_features(features)
+
+    def placement_features(self, game_board, shape=None):
+        """Every valid placement of the shape (the falling shape by default) as (row, column,
+        orientation), and the (placements x features) matrix of the boards they lead to, in the
+        order of the weights. The board is left as it was."""
+        placements = []
+        heights = []
+        counts = []
+        for shape in self.candidate_placements(game_board, shape):
+            placements.append((shape.row_position, shape.column_position, shape.orientation))
+            placement = game_board.apply_placement(shape)
+            heights.append(getHeights(game_board))
+            counts.append((getFullRows(game_board), getHoles(game_board), getHoleDepth(game_board)))
+            game_board.undo_placement(placement)
+        if not placements:
+            return placements, np.empty((0, len(self.weights)), dtype=np.int64)
+        return placements, getFeatureMatrix(np.array(heights), np.array(counts))
+
+    def get_moves_batched(self, game_board):
+        """Same result as get_moves, but all placements are scored with one batch of NumPy operations."""
+        placements, scores = self.placement_scores(game_board)
+        self.nodes_expanded = len(placements)
+        self.total_nodes_expanded += self.nodes_expanded
+        if placements:
+            best = int(np.argmax(scores)) # first of the best, like the strict > in get_moves
+            if scores[best] > -100000:
+                return placements[best]
+        return None, None, None
+
+    def get_moves_lookahead(self, game_board):
+        """Two-piece search: the best first moves (at most beamWidth of them, the others
+        are pruned) are played out with line clears, and then valued by the best
+        placement of the next piece on the resulting board. Boards that were seen
+        before are looked up in the transposition table instead of being searched again."""
+        placements, scores = self.placement_scores(game_board)
+        nodes = len(placements)
+        order = [i for i in np.argsort(-scores, kind='stable')[:self.beamWidth] if scores[i] > -100000]
+
+        falling = game_board.falling_shape
+        next_shape = game_board.next_shape
+        tetromino = type(next_shape)
+        scratch = tetromino(0, 0, next_shape.color, 0) # moved around by the search, next_shape stays where it is
+        best_value = -np.inf
+        best = None
+        for i in order:
+            row, column, orientation = placements[i]
+            falling.orientation = orientation
+            falling.move_to(column, row)
+            board = game_board.deepBoardCopy()
+            clear = board._settle_shape(falling)
+
+            key = (tuple(board.rows), tetromino)
+            leaf = self.transpositions.get(key)
+            if leaf is None:
+                next_placements, next_scores = self.placement_scores(board, scratch)
+                nodes += len(next_placements)
+                leaf = next_scores.max() if next_placements else -np.inf # no room for the next piece: game over
+                if len(self.transpositions) >= TRANSPOSITION_LIMIT:
+                    self.transpositions.clear()
+                self.transpositions[key] = leaf
+
+            # the rows completed by the first move are gone from the board, so count them here
+            value = leaf + (self.weights[0] * len(clear) if clear else 0)
+            if value > best_value:
+                best_value = value
+                best = placements[i]
+
+        self.nodes_expanded = nodes
+        self.total_nodes_expanded += nodes
+        if best is None: # every searched move ends the game, play the best single move
+            best = placements[order[0]] if order else (None, None, None)
+        return best
+
 
 # OLD STUFF, can be deleted when other features are implemented
 def old_get_holes(this_board):
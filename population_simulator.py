@@ -0,0 +1,178 @@
+"""Lock-step simulation of a whole population of headless Tetris games.
+
+All games are stored as one stacked NumPy array (games x rows x columns) and
+advance one piece per step together; finished games are masked out. Placement
+enumeration, landing rows, feature extraction and scoring are done for every
+game at once, so one process can evaluate a whole generation of the
+optimizers with very little interpreter overhead.
+
+Every game makes exactly the same moves as simulator.simulate with the same
+weights, piece limit and seed. EvaluationPool(lockstep=True) plays the games of
+the optimizers this way, one population per worker (see evaluation.play_population).
+"""
+
+import time
+
+import numpy as np
+
+from game_board import NUM_COLUMNS, NUM_ROWS, STARTING_COLUMN, STARTING_ROW, POINTS_PER_LINE
+from pieces import TETROMINOES, PieceSequence
+from players import AI, getFeatureMatrix
+
+PADDING = 4 # filled rows below the board, so a piece can never be lowered out of it
+
+
+def _build_tables():
+    """Index tables of all placements of every tetromino, padded to the same length."""
+    placements = [tetromino.placements(NUM_COLUMNS) for tetromino in TETROMINOES]
+    maxPlacements = max(len(p) for p in placements)
+    shape = (len(TETROMINOES), maxPlacements)
+    cellRows = np.zeros(shape + (4,), dtype=np.intp) # row offset of each cell of a placement
+    cellColumns = np.zeros(shape + (4,), dtype=np.intp) # absolute column of each cell of a placement
+    exists = np.zeros(shape, dtype=bool) # False for the padding
+    spawnRows = np.zeros((len(TETROMINOES), 4), dtype=np.intp)
+    spawnColumns = np.zeros((len(TETROMINOES), 4), dtype=np.intp)
+    for t, tetromino in enumerate(TETROMINOES):
+        for k, (column, orientation) in enumerate(placements[t]):
+            cells = tetromino.orientations[orientation].cells
+            cellRows[t, k] = [row for _, row in cells]
+            cellColumns[t, k] = [column + dx for dx, _ in cells]
+            exists[t, k] = True
+        cells = tetromino.orientations[tetromino.default_orientation].cells
+        spawnRows[t] = [STARTING_ROW + row for _, row in cells]
+        spawnColumns[t] = [STARTING_COLUMN + dx for dx, _ in cells]
+    return cellRows, cellColumns, exists, spawnRows, spawnColumns
+
+
+CELL_ROWS, CELL_COLUMNS, EXISTS, SPAWN_ROWS, SPAWN_COLUMNS = _build_tables()
+TRIAL_ROWS = np.arange(NUM_ROWS + 1) # every row a placement is tested at, one more than fits on the board
+POINTS = np.array(POINTS_PER_LINE)
+
+
+TETROMINO_INDEX = {tetromino: t for t, tetromino in enumerate(TETROMINOES)}
+
+
+def _piece_sequence(seed):
+    """Indices into TETROMINOES, in the same order as the pieces of a Board with this seed."""
+    for tetromino in PieceSequence(seed):
+        yield TETROMINO_INDEX[tetromino]
+
+
+def simulate_population(weights, pieceLimit=-1, seeds=None, timeLimits=None, stop=None):
+    """Plays one game for every weight vector in weights, all in lock-step.
+
+    pieceLimit is the maximum number of pieces per game (-1 for unlimited), or a list
+    with a limit per game; seeds is an optional list with a seed per game (see
+    simulator.simulate). timeLimits is an optional list with a wall-clock budget in
+    seconds (or None) per game, stop an optional function that is checked before every
+    piece and ends all games that are still playing when it returns True.
+    Returns a list with a tuple (score, lines cleared, pieces placed, budget hit) per game,
+    like simulator.simulate.
+    """
+    games = len(weights)
+    if games == 0:
+        return []
+    if seeds is None:
+        seeds = [None] * games
+    weightMatrix = np.array([AI(w).weights for w in weights], dtype=float)
+    sequences = [_piece_sequence(seed) for seed in seeds]
+
+    board = np.zeros((games, NUM_ROWS + PADDING, NUM_COLUMNS), dtype=bool)
+    board[:, NUM_ROWS:] = True
+    scores = np.zeros(games, dtype=np.int64)
+    lines = np.zeros(games, dtype=np.int64)
+    pieces = np.zeros(games, dtype=np.int64)
+    piecesLeft = np.broadcast_to(np.asarray(pieceLimit, dtype=np.int64), (games,)).copy()
+    start = time.perf_counter()
+    deadlines = None
+    if timeLimits is not None:
+        deadlines = np.array([start + limit if limit is not None else np.inf for limit in timeLimits])
+    stopped = np.zeros(games, dtype=bool) # games ended by their time limit or stop
+    nextPiece = np.array([next(sequence) for sequence in sequences])
+    current = np.zeros(games, dtype=np.intp)
+    active = np.ones(games, dtype=bool)
+
+    def spawn(gameIndices):
+        """Brings in the next piece for the given games, and ends the games that are over."""
+        current[gameIndices] = nextPiece[gameIndices]
+        for g in gameIndices:
+            nextPiece[g] = next(sequences[g])
+        blocked = board[gameIndices[:, None], SPAWN_ROWS[current[gameIndices]],
+                        SPAWN_COLUMNS[current[gameIndices]]].any(axis=1)
+        over = blocked | (piecesLeft[gameIndices] == 0)
+        active[gameIndices[over]] = False
+        piecesLeft[gameIndices[~over]] -= 1
+
+    spawn(np.arange(games))
+    while active.any():
+        if stop is not None and stop():
+            stopped |= active
+            break
+        if deadlines is not None:
+            late = active & (deadlines < time.perf_counter())
+            stopped |= late
+            active &= ~late
+            if not active.any():
+                break
+        g = np.flatnonzero(active)
+        t = current[g]
+        cellRows = CELL_ROWS[t] # (games, placements, cells)
+        cellColumns = CELL_COLUMNS[t]
+
+        # collision of every placement at every row: (games, placements, rows)
+        collides = board[g[:, None, None, None],
+                         cellRows[..., None] + TRIAL_ROWS,
+                         cellColumns[..., None]].any(axis=2)
+        # like AI.candidate_placements: start at row 2 and lower the piece until it collides,
+        # if row 2 is already blocked the piece can only stay at row 1
+        fromTwo = ~collides[..., 2]
+        landing = np.where(fromTwo, np.argmax(collides[..., 3:], axis=2) + 2, 1)
+        valid = EXISTS[t] & (fromTwo | ~collides[..., 1])
+        landing[~valid] = 0
+
+        # every candidate board, with the piece placed but no lines cleared
+        gameCount, placementCount = valid.shape
+        candidates = np.repeat(board[g][:, None, :NUM_ROWS], placementCount, axis=1)
+        candidates[np.arange(gameCount)[:, None, None], np.arange(placementCount)[None, :, None],
+                   landing[..., None] + cellRows, cellColumns] = True
+
+        hasBlock = candidates.any(axis=2)
+        tops = np.where(hasBlock, np.argmax(candidates, axis=2), NUM_ROWS)
+        heights = NUM_ROWS - tops
+        fullRows = candidates.all(axis=3).sum(axis=2)
+        holeTops = candidates[:, :, :-1] & ~candidates[:, :, 1:] # empty cell with a block directly above
+        holes = holeTops.sum(axis=2)
+        holeRowSum = (holeTops * np.arange(1, NUM_ROWS)[:, None]).sum(axis=2)
+        holeDepth = (holeRowSum - holes * tops).sum(axis=2)
+        counts = np.stack([fullRows, holes.sum(axis=2), holeDepth], axis=2)
+        features = getFeatureMatrix(heights.reshape(-1, NUM_COLUMNS), counts.reshape(-1, 3))
+        features = features.reshape(gameCount, placementCount, -1)
+
+        # same accumulation order as AI.score_features, so the same moves are picked
+        w = weightMatrix[g]
+        placementScores = features[..., 0] * w[:, None, 0]
+        for i in range(1, w.shape[1]):
+            placementScores += features[..., i] * w[:, None, i]
+        placementScores[~valid] = -np.inf
+        best = np.argmax(placementScores, axis=1)
+        rows = np.arange(gameCount)
+        moved = placementScores[rows, best] > -100000
+        active[g[~moved]] = False
+
+        # settle the chosen pieces and clear the completed lines
+        g, best, rows = g[moved], best[moved], rows[moved]
+        board[g[:, None], landing[rows, best][:, None] + cellRows[rows, best], cellColumns[rows, best]] = True
+        pieces[g] += 1
+        full = board[g, :NUM_ROWS].all(axis=2)
+        cleared = full.sum(axis=1)
+        if cleared.any():
+            # stable sort puts the cleared rows on top, they are then emptied
+            order = np.argsort(~full, axis=1, kind='stable')
+            kept = np.take_along_axis(board[g, :NUM_ROWS], order[..., None], axis=1)
+            kept[np.arange(NUM_ROWS) < cleared[:, None]] = False
+            board[g, :NUM_ROWS] = kept
+            scores[g] += POINTS[cleared]
+            lines[g] += cleared
+        spawn(g)
+
+    return [(int(scores[i]), int(lines[i]), int(pieces[i]), bool(piecesLeft[i] == 0 or stopped[i])) for i in range(games)]
@@ -0,0 +1,110 @@
+"""Opt-in counters and timers of the hot path of the AI.
+
+When profiling is enabled, the features of players (the columns of the batched
+getFeatureMatrix included), AI.score_board, AI.get_moves,
+the candidate placements (Board.apply_placement), placement checks and board copies
+are replaced by wrappers that count their calls and add up their time. Disabled, the
+original functions are in place, so there is no cost at all.
+
+Times are cumulative: AI.get_moves includes the features it computes. Stats are
+plain dicts name -> [calls, seconds], so they can be sent from a worker process
+with its game results and added up with merge.
+"""
+
+import functools
+import os
+import time
+
+import players
+from game_board import Board
+
+PROFILE_DIR = 'profiles'
+
+# (owner, attribute) of everything that is timed; the features are looked up in the
+# module by AI.score_board, AI.placement_scores and getFeatureMatrix, so replacing them there is enough
+INSTRUMENTED = [(players, name) for name in (
+    'getFullRows', 'getHoles', 'getHoleDepth', 'getBumpiness', 'getDeepWells', 'getShallowWells',
+    'getPatternDiversity', 'getDeltaHeight', 'getHeights', 'getFeatureMatrix', 'getWellDepthMatrix',
+    'getBumpinessColumn', 'getDeepWellsColumn', 'getDeltaHeightColumn', 'getShallowWellsColumn',
+    'getPatternDiversityColumn')] + [
+    (players.AI, 'score_board'), (players.AI, 'get_moves'),
+    (Board, 'apply_placement'), (Board, 'shape_cannot_be_placed'), (Board, 'deepBoardCopy')]
+
+_stats = {} # name -> [calls, seconds] since the last collect
+_originals = {} # (owner, attribute) -> the function that was replaced
+
+
+def _label(owner, attribute):
+    return owner.__name__ + '.' + attribute
+
+
+def _timed(function, label):
+    clock = time.perf_counter
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            entry = _stats.get(label)
+            if entry is None:
+                entry = _stats[label] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += clock() - start
+    return wrapper
+
+
+def enable():
+    """Starts counting (in this process)."""
+    for owner, attribute in INSTRUMENTED:
+        if (owner, attribute) not in _originals:
+            function = owner.__dict__[attribute]
+            _originals[(owner, attribute)] = function
+            setattr(owner, attribute, _timed(function, _label(owner, attribute)))
+
+
+def disable():
+    """Puts the original functions back."""
+    for (owner, attribute), function in _originals.items():
+        setattr(owner, attribute, function)
+    _originals.clear()
+
+
+def enabled():
+    return bool(_originals)
+
+
+def collect():
+    """The stats since the last collect, and starts again from zero."""
+    global _stats
+    stats, _stats = _stats, {}
+    return stats
+
+
+def merge(total, stats):
+    """Adds stats to total (both dicts name -> [calls, seconds]), returns total."""
+    for name, (calls, seconds) in stats.items():
+        entry = total.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+    return total
+
+
+def report(stats):
+    """Lines with the calls, total time and time per call of every entry, slowest first."""
+    lines = []
+    for name, (calls, seconds) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        lines.append('%-32s %12d calls %10.3f s %10.2f us/call' % (name, calls, seconds, seconds / calls * 1e6))
+    return lines
+
+
+def log_profile(name, label, stats):
+    """Appends the report of stats, headed by label (e.g. the generation), to PROFILE_DIR/name."""
+    if not stats:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, name), 'a') as file:
+        file.write(str(label) + '\n')
+        for line in report(stats):
+            file.write(line + '\n')
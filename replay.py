@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""Compact binary replays of headless games.
+
+A trace holds what is needed to play a game again without its AI: the seed of the
+piece sequence (or, for an unseeded game, the sequence itself, one byte per piece)
+and one byte per placement with its orientation and the leftmost column of the piece.
+The landing row follows from the board, exactly as the AI found it. Every BLOCK_SIZE
+placements the trace also keeps a snapshot of the board (the block index), so any
+position of a long game is reached by replaying at most BLOCK_SIZE pieces.
+
+Layout (little endian): a header (HEADER), the sequence when the game was unseeded
+(placements + 1 tetromino indices, the last one is the preview at the end), the
+placements, and the block index: per block the score, lines, row masks and row colours
+of the board before its first placement.
+
+    python replay.py TRACE [PIECE]      # shows the board after PIECE placements (default: the end)
+"""
+
+import os
+import struct
+import sys
+
+from game_board import Board, NUM_COLUMNS, NUM_ROWS
+from pieces import TETROMINOES
+
+MAGIC = b'TTRC'
+VERSION = 1
+BLOCK_SIZE = 256 # placements between two snapshots of the board
+HEADER = struct.Struct('<4sBBBBHqIII') # magic, version, flags, columns, rows, block size, seed, placements, score, lines
+SEEDED = 1 # the flag of a trace whose pieces follow from its seed
+REPLAY_DIR = 'replays'
+
+TETROMINO_INDEX = dict((tetromino, index) for index, tetromino in enumerate(TETROMINOES))
+
+
+def replay_path(run, name):
+    """File name of the trace name of a run, in a folder per run under REPLAY_DIR (created when needed)."""
+    folder = os.path.join(REPLAY_DIR, run)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, name + '.trace')
+
+
+def _snapshot_struct(rows):
+    return struct.Struct('<II%dH%dQ' % (rows, rows))
+
+
+class TraceRecorder(object):
+    """Records a game while it is played, see simulator.simulate(recorder=...).
+
+    record is called with every move before it is placed, finish once at the end.
+    """
+
+    def __init__(self, seed=None, blockSize=BLOCK_SIZE):
+        self.seed = seed
+        self.blockSize = blockSize
+        self.moves = bytearray()
+        self.sequence = bytearray() # only kept for unseeded games
+        self.snapshots = []
+        self.columns = NUM_COLUMNS
+        self.rows = NUM_ROWS
+        self.score = 0
+        self.lines = 0
+
+    def record(self, board, column, orientation):
+        """The falling shape of board goes to column with orientation (as passed to
+        Board.place_falling_shape); the board is the one before the placement."""
+        if len(self.moves) % self.blockSize == 0:
+            self.columns, self.rows = board.num_columns, board.num_rows
+            self.snapshots.append((board.score, board.lines_cleared, tuple(board.rows), tuple(board.colors)))
+        shape = board.falling_shape
+        self.moves.append(orientation << 4 | (column + shape.orientations[orientation].min_column))
+        if self.seed is None:
+            self.sequence.append(TETROMINO_INDEX[type(shape)])
+
+    def finish(self, board):
+        """Records the end of the game: its score, and for unseeded games the piece after the last
+        placement. That is the falling shape when the game stopped with no valid placement or on a
+        time limit; a shape that failed to spawn (board full or piece limit) is back in the preview."""
+        self.score = board.score
+        self.lines = board.lines_cleared
+        if self.seed is None:
+            shape = board.falling_shape if board.falling_shape is not None else board.next_shape
+            if shape is not None:
+                self.sequence.append(TETROMINO_INDEX[type(shape)])
+
+    def to_bytes(self):
+        flags = SEEDED if self.seed is not None else 0
+        parts = [HEADER.pack(MAGIC, VERSION, flags, self.columns, self.rows, self.blockSize,
+                             self.seed if self.seed is not None else 0, len(self.moves), self.score, self.lines)]
+        if self.seed is None:
+            parts.append(bytes(self.sequence))
+        parts.append(bytes(self.moves))
+        snapshot = _snapshot_struct(self.rows)
+        for score, lines, rows, colors in self.snapshots:
+            parts.append(snapshot.pack(score, lines, *(rows + colors)))
+        return b''.join(parts)
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            file.write(self.to_bytes())
+
+
+class _RecordedSequence(object):
+    """Stands in for the PieceSequence of a board, handing out the pieces of an unseeded trace."""
+
+    def __init__(self, tetrominoes, index=0):
+        self.tetrominoes = tetrominoes
+        self.index = index
+
+    def copy(self):
+        return _RecordedSequence(self.tetrominoes, self.index)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        tetromino = self.tetrominoes[min(self.index, len(self.tetrominoes) - 1)]
+        self.index += 1
+        return tetromino
+
+
+class Trace(object):
+    """A recorded game, read from the bytes written by TraceRecorder."""
+
+    def __init__(self, data):
+        (magic, version, flags, self.columns, self.rows, self.blockSize, seed, placements,
+         self.score, self.lines) = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a version %d game trace' % VERSION)
+        self.seed = seed if flags & SEEDED else None
+        offset = HEADER.size
+        self.sequence = None
+        if self.seed is None:
+            self.sequence = [TETROMINOES[i] for i in data[offset:offset + placements + 1]]
+            offset += placements + 1
+        self.moves = bytes(data[offset:offset + placements])
+        offset += placements
+        snapshot = _snapshot_struct(self.rows)
+        self.snapshots = [snapshot.unpack_from(data, offset + i * snapshot.size)
+                          for i in range((placements + self.blockSize - 1) // self.blockSize)]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            return cls(file.read())
+
+    def __len__(self):
+        return len(self.moves)
+
+    def move(self, piece):
+        """(orientation, leftmost column) of placement number piece."""
+        move = self.moves[piece]
+        return move >> 4, move & 0xF
+
+    def _board_at_block(self, block):
+        """The board before the first placement of a block, with its falling and next shape."""
+        board = Board(self.columns, self.rows, seed=self.seed)
+        piece = block * self.blockSize
+        if self.seed is None:
+            board.sequence = _RecordedSequence(self.sequence, piece)
+        else:
+            for _ in range(piece): # the bag is cheap to draw from, only the board is expensive to replay
+                next(board.sequence)
+        if block > 0:
+            values = self.snapshots[block]
+            board.score, board.lines_cleared = values[0], values[1]
+            board.rows = list(values[2:2 + self.rows])
+            board.colors = list(values[2 + self.rows:])
+            board._recompute_statistics()
+        board.next_tetromino()
+        board.spawn_shape()
+        return board
+
+    def board_at(self, piece=None):
+        """The board after piece placements (the end of the game by default), with the shape
+        that falls next and the preview as they were in the game."""
+        piece = len(self) if piece is None else piece
+        if not 0 <= piece <= len(self):
+            raise IndexError('the game has %d placements' % len(self))
+        block = min(piece // self.blockSize, len(self.snapshots) - 1) if self.snapshots else 0
+        board = self._board_at_block(block)
+        for i in range(block * self.blockSize, piece):
+            self._place(board, i)
+        return board
+
+    def boards(self):
+        """Every board of the game in turn, from the empty board to the end."""
+        board = self._board_at_block(0)
+        yield board
+        for i in range(len(self)):
+            self._place(board, i)
+            yield board
+
+    def _place(self, board, piece):
+        orientation, column = self.move(piece)
+        shape = board.falling_shape
+        if shape is None or orientation >= len(shape.orientations):
+            raise ValueError('placement %d does not fit the trace' % piece)
+        # the landing row is found like AI.candidate_placements finds it
+        shape.orientation = orientation
+        shape.move_to(column - shape.orientations[orientation].min_column, 2)
+        board.lower_to_landing(shape)
+        if board.shape_cannot_be_placed(shape):
+            raise ValueError('placement %d does not fit the trace' % piece)
+        board._settle_shape(shape)
+        board.falling_shape = None
+        board.spawn_shape()
+
+
+if __name__ == '__main__':
+    trace = Trace.load(sys.argv[1])
+    piece = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    board = trace.board_at(piece)
+    board.printSelf()
+    print('piece %d of %d, score %d (final %d), lines %d, seed %s' % (
+        len(trace) if piece is None else piece, len(trace), board.score, trace.score,
+        board.lines_cleared, trace.seed))
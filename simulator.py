@@ -0,0 +1,50 @@
+"""Headless, high-speed Tetris games for the optimizers.
+
+Plays a game with an AI player without the tick machinery of game.Game: every
+move chosen by the AI is put in place in one step, game over is a return value
+instead of a GameOverError and nothing here needs curses or a terminal.
+"""
+
+import time
+
+from game_board import Board
+from players import AI, BEAM_WIDTH
+
+
+def simulate(weights=None, pieceLimit=-1, seed=None, depth=1, beamWidth=BEAM_WIDTH, timeLimit=None, stop=None,
+             recorder=None):
+    """Plays a single game with the given AI weights.
+
+    pieceLimit is the maximum number of pieces in the game (-1 for unlimited),
+    seed fixes the piece sequence (None draws from the global random state).
+    depth 2 makes the AI look ahead at the next piece, see AI.get_moves_lookahead.
+    timeLimit is an optional wall-clock budget in seconds, stop an optional function
+    that is checked before every piece and ends the game when it returns True.
+    recorder is an optional replay.TraceRecorder that gets every move of the game.
+    Returns a tuple (score, lines cleared, pieces placed, budget hit); budget hit is
+    True when the game did not end by itself but by the piece limit, the time limit
+    or stop, its score is then the partial score so far.
+    """
+    player = AI(weights, depth=depth, beamWidth=beamWidth)
+    board = Board(pieceLimit=pieceLimit, seed=seed)
+    board.next_tetromino()
+    deadline = time.perf_counter() + timeLimit if timeLimit is not None else None
+    piecesPlaced = 0
+    budgetHit = False
+    playing = board.spawn_shape()
+    while playing:
+        if (deadline is not None and time.perf_counter() > deadline) or (stop is not None and stop()):
+            budgetHit = True
+            break
+        row, column, orientation = player.get_moves(board, None)
+        if row is None: # no valid placement left
+            break
+        if recorder is not None:
+            recorder.record(board, column, orientation)
+        playing = board.place_falling_shape(column, row, orientation)
+        piecesPlaced += 1
+    budgetHit = budgetHit or board.pieceLimit == 0
+    if recorder is not None:
+        recorder.finish(board)
+    return board.score, board.lines_cleared, piecesPlaced, budgetHit
+
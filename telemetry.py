@@ -0,0 +1,112 @@
+"""Structured per-generation telemetry of the optimizers.
+
+Every generation (NES: iteration) of a logged run appends one JSON record to
+TELEMETRY_DIR/<name>.jsonl: its results, wall time, cache hits and what the pool
+measured while playing its games (see Telemetry.take). The text logs in the
+*_results folders are written from the same records.
+"""
+
+import json
+import os
+import pickle
+import threading
+import time
+
+TELEMETRY_DIR = 'telemetry'
+
+
+def telemetry_path(name):
+    return os.path.join(TELEMETRY_DIR, name + '.jsonl')
+
+
+def write_record(name, record):
+    """Appends record as one line of JSON to the telemetry of name."""
+    os.makedirs(TELEMETRY_DIR, exist_ok=True)
+    with open(telemetry_path(name), 'a') as file:
+        file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(name):
+    """All records of name, oldest first."""
+    with open(telemetry_path(name)) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def pickled(value):
+    """value pickled, with the seconds that took. The pools and workers send these bytes instead of
+    value, so the time is that of the pickling that actually happens and nothing is pickled twice."""
+    start = time.perf_counter()
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return data, time.perf_counter() - start
+
+
+def summarize(values):
+    """Mean, minimum, median, 90th percentile and maximum of values (None when there are none)."""
+    if not values:
+        return None
+    values = sorted(values)
+    at = lambda fraction: values[min(len(values) - 1, int(fraction * len(values)))]
+    return {'mean': sum(values) / len(values), 'min': values[0], 'p50': at(0.5), 'p90': at(0.9), 'max': values[-1]}
+
+
+class Telemetry(object):
+    """What a pool (EvaluationPool or Broker) measured while playing games since the last take.
+
+    The workers time every game they play and the pickling of their results; the pool
+    adds the time to pickle (or send) its tasks and the completion times of the games of
+    every batch. Games arrive from the threads of the pool, so everything is locked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.start = time.perf_counter()
+        self.durations = [] # seconds per game
+        self.pieces = [] # pieces placed per game
+        self.pickling = 0.0
+        self.stragglers = 0.0
+
+    def add_games(self, results, timing):
+        """results are the (score, lines, pieces, budget hit) of the games of a chunk, timing its
+        (game durations, seconds to pickle the results) as measured by the worker."""
+        durations, pickling = timing
+        with self.lock:
+            self.durations.extend(durations)
+            self.pieces.extend(result[2] for result in results)
+            self.pickling += pickling
+
+    def add_pickling(self, seconds):
+        with self.lock:
+            self.pickling += seconds
+
+    def add_batch(self, completions, workers):
+        """Completion times (perf_counter) of the chunks of a batch. From the moment the first
+        worker finds nothing left to play, the pool waits on stragglers."""
+        if not completions:
+            return
+        completions = sorted(completions)
+        with self.lock:
+            self.stragglers += completions[-1] - completions[max(0, len(completions) - workers)]
+
+    def take(self, workers):
+        """Summary of everything since the last take (or the start) for a pool of workers processes,
+        and starts again."""
+        with self.lock:
+            seconds = time.perf_counter() - self.start
+            busy = sum(self.durations)
+            capacity = workers * seconds
+            summary = {
+                'games': len(self.durations),
+                'gameSeconds': summarize(self.durations),
+                'pieces': summarize(self.pieces),
+                'busySeconds': busy,
+                'workerSeconds': capacity,
+                'utilization': busy / capacity if capacity else None,
+                'idleSeconds': max(0.0, capacity - busy),
+                'stragglerSeconds': self.stragglers,
+                'picklingSeconds': self.pickling,
+            }
+            self._reset()
+        return summary